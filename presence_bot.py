@@ -1,12 +1,35 @@
 import discord
-from discord.ext import commands, tasks
+from discord.ext import commands
 import datetime
 import asyncio
 import os
 import json
+import sqlite3
+import queue
+import signal
+import threading
+import functools
+import heapq
+import bisect
+import hashlib
+import gzip
+import sys
+import time
+import zoneinfo
+from array import array
 from dotenv import load_dotenv
 from aiohttp import web
 
+try:
+    import msgpack  # Optional: enables SNAPSHOT_FORMAT=msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import numpy  # Optional: vectorizes the periodic accrual over the session table
+except ImportError:
+    numpy = None
+
 load_dotenv()
 
 # --- CONSTANTS ---
@@ -15,49 +38,1448 @@ PLAY_TIMES_FILE = os.path.join(DATA_FOLDER, "play_times.json")
 LEADERBOARD_FILE = os.path.join(DATA_FOLDER, "leaderboard.json")
 GAME_ROLES_FILE = os.path.join(DATA_FOLDER, "game_roles.json")
 GAME_LEADERBOARD_FILE = os.path.join(DATA_FOLDER, "game_leaderboard.json")
+GAMES_FILE = os.path.join(DATA_FOLDER, "games.json")  # Game catalog: normalized name -> display name
 
 # --- MODIFIED: Separated channel names for different purposes ---
 WEEKLY_ANNOUNCEMENT_CHANNEL_NAME = "general"
 PRESENCE_CHANNEL_NAME = "presence-update"
 
+milestone_messages = {
+    60: "⏱️ Wow, such dedication! You've been gaming for 1 hour!",
+    120: "🎮 What a gamer! You've reached 2 hours!",
+    180: "🔥 Batak ampota! 3 hours of solid play!",
+    240: "😳 Are you okay? That’s 4 hours!",
+    300: "👀 This is turning into a marathon. 5 hours and counting!",
+}
+# Each milestone gets one bit in ActiveSession.milestones, in ascending order of minutes.
+MILESTONE_BITS = {minutes: 1 << i for i, minutes in enumerate(sorted(milestone_messages))}
+
+# Write-behind persistence: every change is appended to the session event log, which is
+# fsynced in batches every SAVE_INTERVAL_SECONDS (or once SAVE_DIRTY_THRESHOLD lines are
+# buffered). When the log grows past EVENT_LOG_COMPACT_BYTES it is folded into the
+# storage backend's snapshot and started afresh.
+SAVE_INTERVAL_SECONDS = float(os.getenv("SAVE_INTERVAL_SECONDS", "2"))
+SAVE_DIRTY_THRESHOLD = int(os.getenv("SAVE_DIRTY_THRESHOLD", "500"))
+EVENT_LOG_FILE = os.path.join(DATA_FOLDER, "session_events.log")
+EVENT_LOG_COMPACT_BYTES = int(os.getenv("EVENT_LOG_COMPACT_BYTES", str(1024 * 1024)))
+# An accrual tick is logged in lines of at most ACCRUE_BATCH_CREDITS sessions. With many
+# sessions one tick can outgrow EVENT_LOG_COMPACT_BYTES, so the log is also allowed to hold
+# EVENT_LOG_COMPACT_TICKS ticks before it is compacted.
+ACCRUE_BATCH_CREDITS = int(os.getenv("ACCRUE_BATCH_CREDITS", "5000"))
+EVENT_LOG_COMPACT_TICKS = int(os.getenv("EVENT_LOG_COMPACT_TICKS", "8"))
+
+# Snapshot files are written atomically with a checksum header. The previous
+# SNAPSHOT_GENERATIONS versions of each file (and the matching log segments) are kept
+# so a corrupt file can fall back to the last good generation and replay from there.
+SNAPSHOT_GENERATIONS = int(os.getenv("SNAPSHOT_GENERATIONS", "2"))
+SNAPSHOT_HEADER = "#presence-bot"
+
+# Snapshot encoding: "json" (indented, human-readable), "compact" (minified JSON with epoch
+# timestamps) or "msgpack" (binary, needs the msgpack package). Files written in any format,
+# including the original header-less JSON, are always readable.
+SNAPSHOT_FORMAT = os.getenv("SNAPSHOT_FORMAT", "json").lower()
+if SNAPSHOT_FORMAT == "msgpack" and msgpack is None:
+    print("Warning: SNAPSHOT_FORMAT=msgpack needs the 'msgpack' package; using 'compact' instead.")
+    SNAPSHOT_FORMAT = "compact"
+elif SNAPSHOT_FORMAT not in ("json", "compact", "msgpack"):
+    print(f"Warning: Unknown SNAPSHOT_FORMAT '{SNAPSHOT_FORMAT}', falling back to 'json'.")
+    SNAPSHOT_FORMAT = "json"
+
+# All disk I/O runs on one background writer thread fed through a bounded queue.
+WRITER_QUEUE_SIZE = int(os.getenv("WRITER_QUEUE_SIZE", "64"))
+
+# Storage backend: "json" (one file per guild) or "sqlite" (WAL database with per-row upserts).
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()
+SQLITE_DB_FILE = os.path.join(DATA_FOLDER, "presence.db")
+
+# Per-guild data is loaded on first access and dropped after GUILD_IDLE_SECONDS without use.
+GUILD_DATA_FOLDER = os.path.join(DATA_FOLDER, "guilds")
+GUILD_IDLE_SECONDS = float(os.getenv("GUILD_IDLE_SECONDS", "3600"))
+# Leaderboards are re-sorted lazily; up to this many moved keys are re-filed one by one,
+# more than that and the whole list is rebuilt in one pass.
+RANKED_REPAIR_BISECT_LIMIT = int(os.getenv("RANKED_REPAIR_BISECT_LIMIT", "64"))
+
+# Finished sessions are kept in their own database, with hourly, daily and weekly (Monday,
+# UTC) rollups per guild, user and game. HISTORY_MAX_DAYS caps how far back commands look.
+HISTORY_DB_FILE = os.path.join(DATA_FOLDER, "history.db")
+HISTORY_MAX_DAYS = int(os.getenv("HISTORY_MAX_DAYS", "365"))
+
+# Weekly rollover starts a new leaderboard generation; the finished one is appended to a
+# compressed per-guild archive in ARCHIVE_FOLDER instead of being thrown away.
+ARCHIVE_FOLDER = os.path.join(DATA_FOLDER, "archive")
+# Weeks roll over at Monday 00:00 in this timezone, unless a guild sets its own with !timezone.
+ROLLOVER_TIMEZONE = os.getenv("ROLLOVER_TIMEZONE", "UTC")
+
+# Presence-channel posts are queued per channel and sent in batches: lines arriving within
+# PRESENCE_BATCH_SECONDS share one message (split at Discord's length limit). Milestones skip
+# the wait. Past OUTBOX_MAX_LINES pending lines, further updates are only counted.
+PRESENCE_BATCH_SECONDS = float(os.getenv("PRESENCE_BATCH_SECONDS", "2"))
+OUTBOX_MAX_LINES = int(os.getenv("OUTBOX_MAX_LINES", "200"))
+MESSAGE_CHAR_LIMIT = 2000
+
+# Presence flaps: a stop (or going offline) is held for PRESENCE_GRACE_SECONDS before it is
+# committed. If the same game (or the member) comes back within the window, nothing happened.
+PRESENCE_GRACE_SECONDS = float(os.getenv("PRESENCE_GRACE_SECONDS", "30"))
+
+# Game roles are reconciled in batches: members are queued as they change, and after
+# ROLE_SYNC_DELAY_SECONDS each one gets the minimal add/remove to match what they are
+# playing, with at most ROLE_SYNC_CONCURRENCY role calls in flight per guild.
+ROLE_SYNC_DELAY_SECONDS = float(os.getenv("ROLE_SYNC_DELAY_SECONDS", "1"))
+ROLE_SYNC_CONCURRENCY = int(os.getenv("ROLE_SYNC_CONCURRENCY", "4"))
+
+# Startup scan: guild members are requested over the gateway, at most
+# GUILD_CHUNK_CONCURRENCY guilds at a time, instead of being paged through the REST API.
+GUILD_CHUNK_CONCURRENCY = int(os.getenv("GUILD_CHUNK_CONCURRENCY", "4"))
+
+# Presence updates are handed to PRESENCE_WORKERS workers; each member always lands on the
+# same worker, so their events run in order. A full queue (PRESENCE_QUEUE_SIZE) makes the
+# gateway handler wait instead of growing memory without bound.
+PRESENCE_WORKERS = int(os.getenv("PRESENCE_WORKERS", "4"))
+PRESENCE_QUEUE_SIZE = int(os.getenv("PRESENCE_QUEUE_SIZE", "1000"))
+
+# Sharding: AUTO_SHARD=1 runs every shard Discord recommends in this process. To split
+# shards across processes, give each one the same SHARD_COUNT, its own SHARD_IDS (e.g. "0,1")
+# and its own INSTANCE_ID (see below). Leaving all three unset keeps a single unsharded connection.
+SHARD_COUNT = int(os.getenv("SHARD_COUNT")) if os.getenv("SHARD_COUNT") else None
+SHARD_IDS = [int(x) for x in os.getenv("SHARD_IDS", "").split(",") if x.strip()] or None
+SHARDED = bool(SHARD_COUNT or SHARD_IDS or os.getenv("AUTO_SHARD") == "1")
+if SHARD_IDS and not SHARD_COUNT:
+    raise SystemExit("❌ ERROR: SHARD_IDS needs SHARD_COUNT to be set as well.")
+
+# Multi-process mode: give each process its own INSTANCE_ID and they share the SQLite store,
+# each with its own event log. Processes serving the same shards compete for one lease row;
+# the holder does the tracking and runs the periodic and weekly jobs, the rest stand by.
+INSTANCE_ID = os.getenv("INSTANCE_ID", "")
+if SHARD_IDS and set(SHARD_IDS) != set(range(SHARD_COUNT)) and not INSTANCE_ID:
+    # Without it every process would write the same log, sessions file and guild files.
+    raise SystemExit("❌ ERROR: Running a subset of SHARD_IDS needs INSTANCE_ID to be set as well.")
+LEASE_SECONDS = float(os.getenv("LEASE_SECONDS", "30"))
+LEASE_NAME = f"shards:{','.join(map(str, SHARD_IDS))}/{SHARD_COUNT}" if SHARD_IDS else "shards:all"
+if INSTANCE_ID:
+    EVENT_LOG_FILE = os.path.join(DATA_FOLDER, f"session_events.{INSTANCE_ID}.log")
+    if STORAGE_BACKEND != "sqlite":
+        print("Warning: INSTANCE_ID needs the shared SQLite store; using STORAGE_BACKEND=sqlite.")
+        STORAGE_BACKEND = "sqlite"
+
 
 # --- DATA HELPER FUNCTIONS ---
 def setup_data_files():
-    """Ensures the data directory and necessary JSON files exist."""
+    """Ensures the data directories and, for the JSON backend, the sessions file exist."""
     os.makedirs(DATA_FOLDER, exist_ok=True)
-    for file_path in [PLAY_TIMES_FILE, LEADERBOARD_FILE, GAME_ROLES_FILE, GAME_LEADERBOARD_FILE]:
-        if not os.path.exists(file_path):
-            with open(file_path, 'w') as f:
-                json.dump({}, f)
+    if STORAGE_BACKEND == "sqlite":
+        return
+    os.makedirs(GUILD_DATA_FOLDER, exist_ok=True)
+    if not os.path.exists(PLAY_TIMES_FILE):
+        with open(PLAY_TIMES_FILE, 'w') as f:
+            json.dump({}, f)
+
+
+def generation_path(file_path, generation):
+    """Path of an older generation of a data file; generation 0 is the file itself."""
+    return file_path if generation == 0 else f"{file_path}.{generation}"
+
+
+def encode_payload(data, fmt):
+    """Serializes a snapshot payload in the given SNAPSHOT_FORMAT."""
+    if fmt == "msgpack":
+        return msgpack.packb(data)
+    if fmt == "compact":
+        return json.dumps(data, separators=(",", ":")).encode()
+    return json.dumps(data, indent=4).encode()
+
+
+def decode_payload(payload, fmt):
+    """Reverses encode_payload(). Both JSON variants parse the same way."""
+    if fmt == "msgpack":
+        if msgpack is None:
+            raise ValueError("written as msgpack, but the 'msgpack' package is not installed")
+        return msgpack.unpackb(payload, strict_map_key=False)
+    return json.loads(payload)
+
+
+def parse_snapshot(raw):
+    """
+    Parses one snapshot file and returns (data, seq). Files written by older versions have no
+    header and are plain JSON; v1 headers predate the fmt field and are always JSON.
+    Raises ValueError if the checksum does not match.
+    """
+    if not raw.startswith(SNAPSHOT_HEADER.encode()):
+        return json.loads(raw), 0
+    header, _, payload = raw.partition(b"\n")
+    fields = dict(part.split("=", 1) for part in header.decode().split()[1:])
+    if hashlib.sha256(payload).hexdigest() != fields.get("sha256"):
+        raise ValueError("checksum mismatch")
+    return decode_payload(payload, fields.get("fmt", "json")), int(fields.get("seq", 0))
+
+
+def read_snapshot(file_path):
+    """
+    Loads a data file and the log sequence number it covers. Falls back to the newest older
+    generation that passes its checksum if the current file is missing, torn or corrupt.
+    """
+    data, seq, _ = read_snapshot_generation(file_path)
+    return data, seq
+
+
+def read_snapshot_generation(file_path):
+    """Like read_snapshot(), but also returns which generation was read."""
+    for generation in range(SNAPSHOT_GENERATIONS + 1):
+        path = generation_path(file_path, generation)
+        try:
+            with open(path, 'rb') as f:
+                data, seq = parse_snapshot(f.read())
+        except FileNotFoundError:
+            continue
+        except (ValueError, UnicodeDecodeError) as e:
+            print(f"Warning: '{path}' is unreadable ({e}); trying an older generation.")
+            continue
+        if generation:
+            print(f"Warning: Recovered '{file_path}' from generation {generation} (log sequence {seq}).")
+        return data, seq, generation
+    return {}, 0, 0
 
 
 def load_data(file_path):
-    """Loads data from a JSON file."""
-    try:
-        with open(file_path, 'r') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
-
-
-def save_data(file_path, data):
-    """Saves data to a JSON file, handling datetime and set objects."""
-    serializable_data = {}
-    if file_path == PLAY_TIMES_FILE:
-        for user_id, user_data in data.items():
-            serializable_data[user_id] = {
-                "start_time": user_data["start_time"].isoformat(),
-                "last_updated": user_data["last_updated"].isoformat(),
-                "game": user_data["game"],
-                "milestones_hit": list(user_data["milestones_hit"]),
-                "guild_id": user_data["guild_id"],
-                "channel_id": user_data["channel_id"]
+    """Loads data from a JSON data file."""
+    return read_snapshot(file_path)[0]
+
+
+def guild_zone(name=None):
+    """The timezone a guild's week is counted in. Raises ZoneInfoNotFoundError for unknown names."""
+    return zoneinfo.ZoneInfo(name or ROLLOVER_TIMEZONE)
+
+
+def week_start(ts, zone=datetime.UTC, weeks=0):
+    """
+    Epoch of the local Monday 00:00 at or before ts, moved by the given number of weeks.
+    Counted in calendar days, so a DST change in between doesn't shift it by an hour.
+    """
+    day = datetime.datetime.fromtimestamp(ts, zone).date()
+    monday = day - datetime.timedelta(days=day.weekday() - 7 * weeks)
+    return datetime.datetime.combine(monday, datetime.time(), tzinfo=zone).timestamp()
+
+
+def parse_timestamp(value):
+    """Returns epoch seconds from either an ISO string (older files) or an epoch number."""
+    if isinstance(value, str):
+        return datetime.datetime.fromisoformat(value).timestamp()
+    return float(value)
+
+
+class GameCatalog:
+    """
+    Interns game names. Names that differ only in case or spacing ("VALORANT", "Valorant ")
+    share one small integer id, which sessions, leaderboards and role links use in memory.
+    The display name is the first spelling seen. Ids are per process; storage keeps the
+    normalized name, so the store can be shared and ids never have to be persisted.
+    """
+
+    def __init__(self):
+        self.ids = {}  # normalized name -> id
+        self.keys = []  # id -> normalized name
+        self.names = []  # id -> display name
+        self.unsaved = []  # ids whose display name is not in storage yet
+
+    @staticmethod
+    def normalize(name):
+        return " ".join(name.split()).casefold()
+
+    def lookup(self, name):
+        """Returns the id for a name, or None if the game has never been seen. Never adds."""
+        return self.ids.get(self.normalize(name))
+
+    def intern(self, name):
+        key = self.normalize(name)
+        game_id = self.ids.get(key)
+        if game_id is None:
+            game_id = self.ids[key] = len(self.keys)
+            self.keys.append(sys.intern(key))
+            self.names.append(sys.intern(" ".join(name.split())))
+            self.unsaved.append(game_id)
+        return game_id
+
+    def preload(self, names):
+        """Seeds display names from storage ({normalized name: display name})."""
+        for key, name in names.items():
+            if self.normalize(key) not in self.ids:
+                self.intern(name)
+        self.unsaved = []
+
+    def name(self, game_id):
+        return self.names[game_id]
+
+    def key(self, game_id):
+        return self.keys[game_id]
+
+    def take_unsaved(self):
+        """Returns (normalized name, display name) for every game added since the last call."""
+        unsaved, self.unsaved = self.unsaved, []
+        return [(self.keys[game_id], self.names[game_id]) for game_id in unsaved]
+
+    def to_record(self):
+        return dict(zip(self.keys, self.names))
+
+
+game_catalog = GameCatalog()
+
+
+class ActiveSession:
+    """
+    One tracked play session. Slotted, with epoch-second timestamps and a bitmask of the
+    milestones already announced, so thousands of concurrent sessions stay small and
+    cheap to serialize.
+    """
+
+    __slots__ = ("guild_id", "channel_id", "game_id", "start_time", "_last_updated", "milestones", "row")
+
+    def __init__(self, guild_id, channel_id, game_id, start_time, last_updated=None, milestones=0):
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.game_id = game_id  # Interned through game_catalog
+        self.start_time = start_time
+        self._last_updated = start_time if last_updated is None else last_updated
+        self.milestones = milestones
+        self.row = None  # Row in session_table while the session is live
+
+    @property
+    def game(self):
+        """Display name of the game."""
+        return game_catalog.name(self.game_id)
+
+    @property
+    def last_updated(self):
+        """Lives in session_table while the session is active, on the object once it has ended."""
+        return self._last_updated if self.row is None else session_table.last_updated[self.row]
+
+    @last_updated.setter
+    def last_updated(self, value):
+        if self.row is None:
+            self._last_updated = value
+        else:
+            session_table.last_updated[self.row] = value
+
+    def has_milestone(self, minutes):
+        return bool(self.milestones & MILESTONE_BITS[minutes])
+
+    def add_milestone(self, minutes):
+        self.milestones |= MILESTONE_BITS.get(minutes, 0)
+
+    def milestones_hit(self):
+        return [minutes for minutes, bit in MILESTONE_BITS.items() if self.milestones & bit]
+
+    def to_record(self):
+        """Serializable form: a readable dict for plain JSON, a flat list for the compact formats."""
+        if SNAPSHOT_FORMAT == "json":
+            return {
+                "start_time": datetime.datetime.fromtimestamp(self.start_time, datetime.UTC).isoformat(),
+                "last_updated": datetime.datetime.fromtimestamp(self.last_updated, datetime.UTC).isoformat(),
+                "game": self.game,
+                "milestones_hit": self.milestones_hit(),
+                "guild_id": self.guild_id,
+                "channel_id": self.channel_id
             }
-    else:
-        serializable_data = data
+        # Milestones are stored as minutes rather than the mask so adding one never remaps old bits.
+        return [self.start_time, self.last_updated, self.game, self.milestones_hit(), self.guild_id, self.channel_id]
+
+    @classmethod
+    def from_record(cls, data):
+        """Reverses to_record(), also accepting the dict records written by older versions."""
+        if isinstance(data, list):
+            start_time, last_updated, game, milestones_hit, guild_id, channel_id = data
+        else:
+            start_time = parse_timestamp(data["start_time"])
+            last_updated = parse_timestamp(data.get("last_updated", data["start_time"]))
+            game, milestones_hit = data["game"], data.get("milestones_hit", [])
+            guild_id, channel_id = data["guild_id"], data["channel_id"]
+        session = cls(guild_id, channel_id, game_catalog.intern(game), start_time, last_updated)
+        for minutes in milestones_hit:
+            session.add_milestone(minutes)
+        return session
+
+
+class SessionTable:
+    """
+    Columnar view of the active sessions: parallel arrays of user id, guild id, game
+    catalog id and last_updated, one row per session. The periodic accrual works on these
+    flat arrays (vectorized when numpy is installed) instead of walking session objects.
+    Rows are removed by moving the last row into the gap, so every change is O(1).
+    """
+
+    def __init__(self):
+        self.users = array("q")
+        self.guilds = array("q")
+        self.games = array("q")
+        self.last_updated = array("d")
+        self.sessions = []  # row -> ActiveSession
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def columns(self):
+        return self.users, self.guilds, self.games, self.last_updated
+
+    def add(self, user_id, session):
+        for column, value in zip(self.columns(), (user_id, session.guild_id, session.game_id, session._last_updated)):
+            column.append(value)
+        session.row = len(self.sessions)
+        self.sessions.append(session)
+
+    def remove(self, session):
+        row, last = session.row, len(self.sessions) - 1
+        session._last_updated = self.last_updated[row]
+        session.row = None
+        if row != last:
+            for column in self.columns():
+                column[row] = column[last]
+            moved = self.sessions[row] = self.sessions[last]
+            moved.row = row
+        for column in self.columns():
+            column.pop()
+        self.sessions.pop()
+
+    def clear(self):
+        for session in list(self.sessions):
+            self.remove(session)
+
+    def stamp(self, rows, value):
+        """Sets last_updated on many rows at once."""
+        if numpy is not None and rows:
+            numpy.frombuffer(self.last_updated, dtype=numpy.float64)[rows] = value
+        else:
+            column = self.last_updated
+            for row in rows:
+                column[row] = value
+
+    def credits(self, now, skip_users, skip_shards, shard_count, batch_size):
+        """
+        Playtime owed to every session since its last update, rounded to the millisecond, in
+        batches of at most batch_size sessions. Each batch maps guild id -> game ->
+        {"users": [...], "seconds": [...], "total": seconds}. Sessions of skip_users, or in
+        guilds on skip_shards, are left out.
+        """
+        skip_users, skip_shards = set(skip_users), set(skip_shards)
+        if numpy is not None and self.sessions:
+            groups = self.credit_groups_vectorized(now, skip_users, skip_shards, shard_count)
+        else:
+            groups = self.credit_groups(now, skip_users, skip_shards, shard_count)
+        names = game_catalog.names
+        batches, batch, size = [], {}, 0
+        for guild_id_str, game_id, users, seconds, total in groups:
+            parts = [(users, seconds, total)] if len(users) <= batch_size else [
+                (users[i:i + batch_size], seconds[i:i + batch_size], sum(seconds[i:i + batch_size]))
+                for i in range(0, len(users), batch_size)]
+            for part_users, part_seconds, part_total in parts:
+                if size + len(part_users) > batch_size and size:
+                    batches.append(batch)
+                    batch, size = {}, 0
+                games = batch.get(guild_id_str)
+                if games is None:
+                    games = batch[guild_id_str] = {}
+                games[names[game_id]] = {"users": part_users, "seconds": part_seconds, "total": part_total}
+                size += len(part_users)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def credit_groups(self, now, skip_users, skip_shards, shard_count):
+        """(guild id str, game id, user ids, seconds, total) per guild and game, one row at a time."""
+        grouped = {}
+        for user_id, guild_id, game_id, last_updated in zip(*self.columns()):
+            if user_id in skip_users or (guild_id >> 22) % shard_count in skip_shards: continue
+            users, seconds = grouped.setdefault((str(guild_id), game_id), ([], []))
+            users.append(user_id)
+            seconds.append(round(max(0.0, now - last_updated), 3))
+        return [(guild_id_str, game_id, users, seconds, sum(seconds))
+                for (guild_id_str, game_id), (users, seconds) in grouped.items()]
+
+    def credit_groups_vectorized(self, now, skip_users, skip_shards, shard_count):
+        """
+        Same as credit_groups(), but filtering, grouping and the per-group totals run on whole
+        arrays: rows are sorted by guild and game, and each group is a contiguous slice.
+        """
+        users = numpy.frombuffer(self.users, dtype=numpy.int64)
+        guilds = numpy.frombuffer(self.guilds, dtype=numpy.int64)
+        games = numpy.frombuffer(self.games, dtype=numpy.int64)
+        keep = numpy.ones(len(users), dtype=bool)
+        if skip_users:
+            keep &= ~numpy.isin(users, list(skip_users))
+        if skip_shards:
+            keep &= ~numpy.isin((guilds >> 22) % shard_count, list(skip_shards))
+        rows = numpy.flatnonzero(keep)
+        if not len(rows): return []
+        rows = rows[numpy.lexsort((games[rows], guilds[rows]))]
+        group_guilds, group_games = guilds[rows], games[rows]
+        owed = numpy.round(numpy.maximum(0.0, now - numpy.frombuffer(self.last_updated, dtype=numpy.float64)[rows]), 3)
+        starts = numpy.flatnonzero(numpy.r_[True, (group_guilds[1:] != group_guilds[:-1]) |
+                                                  (group_games[1:] != group_games[:-1])])
+        totals = numpy.add.reduceat(owed, starts).tolist()
+        # One bulk conversion each; the per-group lists below are plain list slices.
+        user_list, owed_list = users[rows].tolist(), owed.tolist()
+        guild_keys = list(map(str, group_guilds[starts].tolist()))
+        bounds = starts.tolist() + [len(rows)]
+        return [(guild_id_str, game_id, user_list[a:b], owed_list[a:b], total)
+                for guild_id_str, game_id, a, b, total in zip(guild_keys, group_games[starts].tolist(),
+                                                              bounds, bounds[1:], totals)]
+
+
+class SessionMap(dict):
+    """
+    playing_start_times: user id -> ActiveSession. Every change also updates session_table
+    and a guild -> game id -> user ids index, so "who is playing X here" costs the size of
+    the answer rather than a scan over every session.
+    """
+
+    def __init__(self, sessions=()):
+        super().__init__()
+        self.guild_games = {}
+        self.update(sessions)
+
+    def __setitem__(self, user_id, session):
+        previous = self.get(user_id)
+        if previous is not None:
+            self.unindex(user_id, previous)
+        super().__setitem__(user_id, session)
+        session_table.add(user_id, session)
+        self.guild_games.setdefault(session.guild_id, {}).setdefault(session.game_id, set()).add(user_id)
+
+    def __delitem__(self, user_id):
+        self.unindex(user_id, self[user_id])
+        super().__delitem__(user_id)
+
+    def pop(self, user_id, *default):
+        session = super().pop(user_id, *default)
+        if isinstance(session, ActiveSession) and session.row is not None:
+            self.unindex(user_id, session)
+        return session
+
+    def clear(self):
+        session_table.clear()
+        self.guild_games.clear()
+        super().clear()
+
+    def unindex(self, user_id, session):
+        session_table.remove(session)
+        games = self.guild_games[session.guild_id]
+        players = games[session.game_id]
+        players.discard(user_id)
+        if not players:
+            del games[session.game_id]
+            if not games:
+                del self.guild_games[session.guild_id]
+
+    def players(self, guild_id, game_id):
+        """User ids playing a game in a guild."""
+        return self.guild_games.get(guild_id, {}).get(game_id, set())
+
+    def games_in(self, guild_id):
+        """game id -> user ids for everything being played in a guild."""
+        return self.guild_games.get(guild_id, {})
+
+    def update(self, sessions=(), **kwargs):
+        for user_id, session in dict(sessions, **kwargs).items():
+            self[user_id] = session
+
+
+session_table = SessionTable()
+
+
+def save_data(file_path, data, seq=0):
+    """
+    Saves already-serializable data in SNAPSHOT_FORMAT without ever leaving a torn file behind:
+    the new version is written to a temp file with a checksum header, fsynced, and renamed
+    into place after the current version has been rotated to generation 1.
+    """
+    payload = encode_payload(data, SNAPSHOT_FORMAT)
+    header = f"{SNAPSHOT_HEADER} v=2 fmt={SNAPSHOT_FORMAT} seq={seq} sha256={hashlib.sha256(payload).hexdigest()}\n"
+    temp_path = file_path + ".tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(header.encode() + payload)
+        f.flush()
+        os.fsync(f.fileno())
+    rotate_generations(file_path)
+    os.replace(temp_path, file_path)
+    fsync_directory(os.path.dirname(file_path))
+
+
+def rotate_generations(file_path):
+    """Shifts file -> file.1 -> file.2 ..., dropping the oldest generation."""
+    for generation in range(SNAPSHOT_GENERATIONS, 0, -1):
+        older = generation_path(file_path, generation - 1)
+        if os.path.exists(older):
+            os.replace(older, generation_path(file_path, generation))
+
+
+def fsync_directory(path):
+    """Makes renames durable. Not supported on every platform, where it is skipped."""
+    try:
+        fd = os.open(path or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+# --- WRITE-BEHIND PERSISTENCE ---
+class PendingChanges:
+    """Changes made in memory since the last flush, coalesced per row."""
+
+    def __init__(self):
+        self.user_seconds = {}  # guild_id_str -> user_id_str -> seconds to add
+        self.game_seconds = {}  # (guild_id_str, game_id) -> seconds to add
+        self.sessions = set()  # user ids whose active session started, changed or ended
+        self.game_roles = set()  # (guild_id_str, game_id) whose role link changed
+        self.reset_guilds = set()  # guild ids whose leaderboards were wiped
+        self.guilds = set()  # every guild id touched by any of the above
+        self.count = 0
+
+    def __bool__(self):
+        return self.count > 0
+
+    def add_user_seconds(self, guild_id_str, user_id_str, seconds):
+        users = self.user_seconds.setdefault(guild_id_str, {})
+        users[user_id_str] = users.get(user_id_str, 0) + seconds
+        self.guilds.add(guild_id_str)
+        self.count += 1
+
+    def add_user_seconds_many(self, guild_id_str, amounts):
+        users = self.user_seconds.get(guild_id_str)
+        if users is None:
+            self.user_seconds[guild_id_str] = dict(amounts)
+        else:
+            get = users.get
+            for user_id_str, seconds in amounts.items():
+                users[user_id_str] = get(user_id_str, 0) + seconds
+        self.guilds.add(guild_id_str)
+        self.count += len(amounts)
+
+    def add_game_seconds(self, guild_id_str, game_id, seconds):
+        key = (guild_id_str, game_id)
+        self.game_seconds[key] = self.game_seconds.get(key, 0) + seconds
+        self.guilds.add(guild_id_str)
+        self.count += 1
+
+    def touch_session(self, user_id):
+        self.sessions.add(user_id)
+        self.count += 1
+
+    def touch_sessions(self, user_ids):
+        self.sessions.update(user_ids)
+        self.count += len(user_ids)
 
-    with open(file_path, 'w') as f:
-        json.dump(serializable_data, f, indent=4)
+    def touch_game_role(self, guild_id_str, game_id):
+        self.game_roles.add((guild_id_str, game_id))
+        self.guilds.add(guild_id_str)
+        self.count += 1
+
+    def touch_guild(self, guild_id_str):
+        self.guilds.add(guild_id_str)
+        self.count += 1
+
+    def reset_guild(self, guild_id_str):
+        # Increments recorded before the wipe must not be re-applied after it.
+        self.user_seconds.pop(guild_id_str, None)
+        self.game_seconds = {k: v for k, v in self.game_seconds.items() if k[0] != guild_id_str}
+        self.reset_guilds.add(guild_id_str)
+        self.touch_generation(guild_id_str)
+
+    def touch_generation(self, guild_id_str):
+        # Generation state is saved with the rest of the guild.
+        self.guilds.add(guild_id_str)
+        self.count += 1
+
+
+pending_changes = PendingChanges()
+
+
+def mark_dirty():
+    """Called after logging an event. Flushes early once SAVE_DIRTY_THRESHOLD lines are buffered."""
+    if len(event_log.buffer) >= SAVE_DIRTY_THRESHOLD and not writer.jobs.full():
+        flush_data()
+
+
+def flush_data(block=False):
+    """
+    Hands buffered events to the writer thread (one append and fsync per batch) and schedules
+    a compaction once the log is large. Never touches the disk itself. If the writer queue is
+    full the events simply stay buffered until the next call.
+    """
+    if not block and writer.jobs.full():
+        return False
+    lines = event_log.buffer
+    if lines:
+        if not writer.submit(functools.partial(event_log.write, lines), block=block):
+            return False
+        event_log.buffer = []
+        event_log.size += sum(len(line) + 1 for line in lines)
+    rows = session_history.pending
+    if rows:
+        # Queued after the log lines, so history never gets ahead of the durable log.
+        if not writer.submit(functools.partial(session_history.write, rows), block=block):
+            return False
+        session_history.pending = []
+    archived = week_archive.pending
+    if archived:
+        if not writer.submit(functools.partial(week_archive.write, archived), block=block):
+            return False
+        week_archive.pending = []
+    if event_log.size >= max(EVENT_LOG_COMPACT_BYTES, EVENT_LOG_COMPACT_TICKS * event_log.tick_bytes):
+        return compact_data(block)
+    if INSTANCE_ID and pending_changes:
+        return sync_store(block)
+    return True
+
+
+def sync_store(block=False):
+    """
+    In multi-process mode other instances only see the shared store, not this log, so every
+    flush also pushes the increments and session state there. The log is not rotated; the
+    stored sequence just moves up so a restart doesn't replay what the store already has.
+    """
+    global pending_changes
+    if not block and writer.jobs.full():
+        return False
+    if not writer.submit(storage.snapshot(pending_changes, event_log.seq), block=block):
+        return False
+    pending_changes = PendingChanges()
+    return True
+
+
+def compact_data(block=False):
+    """Folds everything logged since the last snapshot into the storage backend and rotates the log."""
+    global pending_changes
+    if event_log.buffer and not flush_data(block):
+        return False
+    if not block and writer.jobs.full():
+        return False
+    # The snapshot is copied here on the event loop; the writer thread only serializes it.
+    # It records the last sequence number it covers before the log is rotated, so a crash
+    # in between only means replaying events that are then skipped.
+    write_snapshot = storage.snapshot(pending_changes, event_log.seq)
+
+    def compact():
+        write_snapshot()
+        event_log.rotate()
+
+    if not writer.submit(compact, block=block):
+        return False
+    pending_changes = PendingChanges()
+    event_log.size = 0
+    return True
+
+
+class PersistenceWriter:
+    """Background thread that owns all disk I/O. Jobs are plain callables run in submission order."""
+
+    def __init__(self, maxsize):
+        self.jobs = queue.Queue(maxsize=maxsize)
+        self.thread = threading.Thread(target=self.run, name="persistence-writer", daemon=True)
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.full_episodes = 0
+        self.saturated = False
+        self.peak_depth = 0
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, job, block=False):
+        """Queues a job. Returns False instead of waiting when the queue is full, unless block is set."""
+        try:
+            self.jobs.put(job, block=block)
+        except queue.Full:
+            self.rejected += 1
+            if not self.saturated:
+                # Warn once per episode; the rest is counted in /metrics.
+                self.saturated = True
+                self.full_episodes += 1
+                print(f"Warning: Persistence queue is full ({self.jobs.maxsize} jobs); deferring writes.")
+            return False
+        if self.saturated:
+            self.saturated = False
+            print(f"INFO: Persistence queue has room again ({self.rejected} writes deferred so far).")
+        self.peak_depth = max(self.peak_depth, self.jobs.qsize())
+        return True
+
+    async def call(self, fn, *args):
+        """Runs fn on the writer thread after everything queued before it, and awaits its result."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve(result, error):
+            if future.done(): return
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        def job():
+            try:
+                result = fn(*args)
+            except Exception as e:
+                loop.call_soon_threadsafe(resolve, None, e)
+                raise
+            loop.call_soon_threadsafe(resolve, result, None)
+
+        while not self.submit(job):
+            await asyncio.sleep(0.1)
+        return await future
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None: return
+                job()
+                self.completed += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"Error: Persistence job failed: {e}")
+            finally:
+                self.jobs.task_done()
+
+    def stop(self):
+        """Drains the queue and waits for the thread to finish."""
+        if not self.thread.is_alive(): return
+        self.jobs.put(None)
+        self.thread.join()
+
+    def stats(self):
+        return {
+            "queue_depth": self.jobs.qsize(),
+            "queue_capacity": self.jobs.maxsize,
+            "peak_depth": self.peak_depth,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "full_episodes": self.full_episodes,
+            "saturated": self.saturated,
+        }
+
+
+writer = PersistenceWriter(WRITER_QUEUE_SIZE)
+
+
+# --- GUILD DATA ---
+class RankedIndex:
+    """
+    A leaderboard kept in rank order: scores by key, plus a sorted list of (-score, key).
+    Updates only touch the scores; the list is repaired on the next read.
+    """
+
+    def __init__(self, scores=None):
+        self.scores = dict(scores or {})
+        self.ranked = sorted((-score, key) for key, score in self.scores.items())
+        self.moved = {}  # key -> score it is still filed under in ranked (None if not filed yet)
+
+    def __len__(self):
+        return len(self.scores)
+
+    def get(self, key, default=None):
+        return self.scores.get(key, default)
+
+    def add(self, key, amount):
+        """Adds to a key's score."""
+        old = self.scores.get(key)
+        if key not in self.moved:
+            self.moved[key] = old
+        self.scores[key] = (old or 0) + amount
+
+    def add_many(self, amounts):
+        """Adds a whole mapping of key -> amount, e.g. one tick's credits."""
+        scores, moved = self.scores, self.moved
+        for key, amount in amounts.items():
+            old = scores.get(key)
+            if key not in moved:
+                moved[key] = old
+            scores[key] = (old or 0) + amount
+
+    def repair(self):
+        """Files moved keys at their new positions."""
+        moved = self.moved
+        if not moved: return
+        self.moved = {}
+        if len(moved) <= RANKED_REPAIR_BISECT_LIMIT:
+            for key, old in moved.items():
+                if old is not None:
+                    del self.ranked[bisect.bisect_left(self.ranked, (-old, key))]
+                bisect.insort(self.ranked, (-self.scores[key], key))
+            return
+        # One linear pass: drop the stale entries, then merge in the new ones. sort() on two
+        # sorted runs is a single merge.
+        ranked = [entry for entry in self.ranked if entry[1] not in moved]
+        ranked += sorted((-self.scores[key], key) for key in moved)
+        ranked.sort()
+        self.ranked = ranked
+
+    def top(self, n):
+        """The n highest (key, score) pairs, best first."""
+        self.repair()
+        return [(key, -neg_score) for neg_score, key in self.ranked[:n]]
+
+    def rank(self, key):
+        """1-based position of key, or None if it has no score."""
+        score = self.scores.get(key)
+        if score is None: return None
+        self.repair()
+        return bisect.bisect_left(self.ranked, (-score, key)) + 1
+
+
+class GuildData:
+    """
+    One guild's leaderboards and game-role links. Loaded on first access, evicted when idle.
+    The leaderboards belong to one generation (usually a week); a rollover swaps in empty
+    ones and archives the old pair.
+    """
+
+    def __init__(self, users=None, games=None, roles=None, seq=0, generation=0, started=None, announced=None,
+                 timezone=None):
+        self.users = RankedIndex(users)  # user_id_str -> seconds played this week
+        # Stored games are keyed by name; spelling variants from older files merge here.
+        merged = {}
+        for name, seconds in (games or {}).items():
+            game_id = game_catalog.intern(name)
+            merged[game_id] = merged.get(game_id, 0) + seconds
+        self.games = RankedIndex(merged)  # game_id -> seconds played this week
+        self.roles = {game_catalog.intern(name): role_id for name, role_id in (roles or {}).items()}  # game_id -> role_id
+        # Last log sequence the stored copy covers, per dataset; only consulted during replay.
+        self.floors = dict.fromkeys(("leaderboard", "game_leaderboard", "game_roles"), seq)
+        self.last_access = time.monotonic()
+        self.generation = generation
+        self.timezone = timezone  # None follows ROLLOVER_TIMEZONE
+        # Data from before generations existed is taken to belong to the current week. That
+        # choice has to be saved, or every reload would move the start up to the current week.
+        self.generation_unsaved = started is None
+        self.recovered = False  # Read from an older generation after the current file failed its checksum
+        self.started = week_start(time.time(), self.zone()) if started is None else started
+        self.announced = generation - 1 if announced is None else announced  # Last generation announced
+
+    def zone(self):
+        try:
+            return guild_zone(self.timezone)
+        except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+            return datetime.UTC  # tzdata went missing since it was set
+
+    def generation_record(self, ended):
+        """The current generation's leaderboards in archive form."""
+        return {"generation": self.generation, "started": self.started, "ended": ended,
+                "users": dict(self.users.scores),
+                "games": {game_catalog.key(game_id): seconds for game_id, seconds in self.games.scores.items()}}
+
+    def to_record(self):
+        return {"users": dict(self.users.scores),
+                "games": {game_catalog.key(game_id): seconds for game_id, seconds in self.games.scores.items()},
+                "roles": {game_catalog.key(game_id): role_id for game_id, role_id in self.roles.items()},
+                "generation": self.generation, "started": self.started, "announced": self.announced,
+                "timezone": self.timezone}
+
+
+guild_cache = {}  # guild_id_str -> GuildData for every resident guild
+
+
+def get_guild_data(guild_id):
+    """
+    Returns a guild's data, reading it from storage on first access. Live code paths
+    call load_guild_data() first so that the read happens on the writer thread; the
+    synchronous read here is only hit while replaying the log at startup.
+    """
+    key = str(guild_id)
+    data = guild_cache.get(key)
+    if data is None:
+        data = cache_guild(key, storage.load_guild(key))
+    data.last_access = time.monotonic()
+    return data
+
+
+def cache_guild(key, data):
+    """Makes a freshly loaded guild resident, queueing its generation state if it has none stored."""
+    guild_cache[key] = data
+    if data.generation_unsaved:
+        data.generation_unsaved = False
+        pending_changes.touch_generation(key)
+    if data.recovered:
+        data.recovered = False
+        replay_recovered_guild(key, data)
+    return data
+
+
+def replay_recovered_guild(key, data):
+    """Brings a guild read from an older generation up to date from the retained log segments."""
+    floors = {"play_times": float("inf")}  # Only the guild's own datasets are behind
+    replayed = 0
+    for event in event_log.read(min(data.floors.values())):
+        if replay_position is not None and event["seq"] >= replay_position: break
+        if event["type"] == "accrue":
+            if key not in event["guilds"]: continue
+            event = dict(event, guilds={key: event["guilds"][key]})
+        elif str(event.get("guild")) != key:
+            continue
+        apply_event(event, floors)
+        replayed += 1
+    pending_changes.touch_guild(key)  # Write a good current copy at the next compaction
+    print(f"INFO: Replayed {replayed} logged events for recovered guild {key}.")
+
+
+async def load_guild_data(guild_id):
+    """Makes sure a guild is resident, loading it on the writer thread if it is not."""
+    key = str(guild_id)
+    if key not in guild_cache:
+        data = await writer.call(storage.load_guild, key)
+        if key not in guild_cache:  # Another task may have loaded it while we waited
+            cache_guild(key, data)
+    return get_guild_data(key)
+
+
+def evict_idle_guilds():
+    """Drops guilds untouched for GUILD_IDLE_SECONDS that have no active sessions or unsaved changes."""
+    cutoff = time.monotonic() - GUILD_IDLE_SECONDS
+    busy = {str(info.guild_id) for info in playing_start_times.values()} | pending_changes.guilds
+    evicted = 0
+    for key, data in list(guild_cache.items()):
+        if data.last_access < cutoff and key not in busy:
+            del guild_cache[key]
+            evicted += 1
+    return evicted
+
+
+# --- STORAGE BACKENDS ---
+class JsonStorage:
+    """
+    Active sessions live in play_times.json and every guild has its own file in
+    GUILD_DATA_FOLDER, so a flush rewrites only the guilds that changed.
+    """
+
+    LEGACY_FILES = {
+        "leaderboard": LEADERBOARD_FILE,
+        "game_leaderboard": GAME_LEADERBOARD_FILE,
+        "game_roles": GAME_ROLES_FILE,
+    }
+
+    def __init__(self):
+        self.legacy_files = [path for path in self.LEGACY_FILES.values() if os.path.exists(path)]
+
+    def guild_path(self, guild_id_str):
+        return os.path.join(GUILD_DATA_FOLDER, f"{guild_id_str}.json")
+
+    def load(self):
+        game_catalog.preload(load_data(GAMES_FILE))
+        play_times, seq = read_snapshot(PLAY_TIMES_FILE)
+        if self.legacy_files:
+            self.load_legacy_files()
+        return {"play_times": play_times, "floors": {"play_times": seq}}
+
+    def load_legacy_files(self):
+        """
+        Migration from the single-file layout: every guild in the old files becomes resident
+        and dirty, so the first compaction writes the per-guild files and retires the old ones.
+        Each dataset keeps the log sequence of the file it came from for the replay.
+        """
+        legacy = {name: read_snapshot(path) for name, path in self.LEGACY_FILES.items()}
+        guild_ids = set().union(*(data for data, _ in legacy.values()))
+        for guild_id_str in guild_ids:
+            data = GuildData(legacy["leaderboard"][0].get(guild_id_str),
+                             legacy["game_leaderboard"][0].get(guild_id_str),
+                             legacy["game_roles"][0].get(guild_id_str))
+            data.floors = {name: seq for name, (_, seq) in legacy.items()}
+            guild_cache[guild_id_str] = data
+            pending_changes.touch_guild(guild_id_str)
+        print(f"INFO: Splitting {len(guild_ids)} guilds from the single-file layout into '{GUILD_DATA_FOLDER}'.")
+
+    def load_guild(self, guild_id_str):
+        data, seq, generation = read_snapshot_generation(self.guild_path(guild_id_str))
+        guild_data = GuildData(data.get("users"), data.get("games"), data.get("roles"), seq, data.get("generation", 0),
+                               data.get("started"), data.get("announced"), data.get("timezone"))
+        guild_data.recovered = generation > 0
+        return guild_data
+
+    def snapshot(self, changes, seq):
+        """Copies the changed guilds and sessions and returns a job that writes them out."""
+        files = [(self.guild_path(g), guild_cache[g].to_record()) for g in changes.guilds]
+        if game_catalog.take_unsaved():
+            files.insert(0, (GAMES_FILE, game_catalog.to_record()))
+        if changes.sessions:
+            files.append((PLAY_TIMES_FILE, {user_id: info.to_record()
+                                            for user_id, info in playing_start_times.items()}))
+        legacy_files, self.legacy_files = self.legacy_files, []
+
+        def write():
+            for file_path, data in files:
+                save_data(file_path, data, seq)
+            for path in legacy_files:
+                os.replace(path, path + ".pre-shard")
+        return write
+
+
+class SqliteStorage:
+    """SQLite backend in WAL mode. Flushes upsert only the changed rows; several processes can share one database."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS user_playtime (
+            guild_id TEXT NOT NULL, user_id TEXT NOT NULL, seconds REAL NOT NULL,
+            PRIMARY KEY (guild_id, user_id));
+        CREATE TABLE IF NOT EXISTS game_playtime (
+            guild_id TEXT NOT NULL, game TEXT NOT NULL, seconds REAL NOT NULL,
+            PRIMARY KEY (guild_id, game));
+        CREATE TABLE IF NOT EXISTS game_roles (
+            guild_id TEXT NOT NULL, game TEXT NOT NULL, role_id INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, game));
+        CREATE TABLE IF NOT EXISTS active_sessions (
+            owner TEXT NOT NULL, user_id INTEGER NOT NULL, record TEXT NOT NULL,
+            PRIMARY KEY (owner, user_id));
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS games (game TEXT PRIMARY KEY, name TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS guild_generations (
+            guild_id TEXT PRIMARY KEY, generation INTEGER NOT NULL, started REAL NOT NULL, announced INTEGER NOT NULL,
+            timezone TEXT);
+    """
+
+    def __init__(self, db_path):
+        # Loaded on the main thread at startup, then used only by the writer thread.
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=10000")  # Wait out other processes' transactions
+        self.conn.executescript(self.SCHEMA)
+        self.migrate_active_sessions()
+        if "timezone" not in [row[1] for row in self.conn.execute("PRAGMA table_info(guild_generations)")]:
+            with self.conn:
+                self.conn.execute("ALTER TABLE guild_generations ADD COLUMN timezone TEXT")
+        # Without INSTANCE_ID everything stays under the original unscoped names.
+        self.owner = LEASE_NAME if INSTANCE_ID else ""
+        self.seq_key = f"log_seq:{INSTANCE_ID}" if INSTANCE_ID else "log_seq"
+        with self.conn:
+            # Claiming the flag first makes sure only one process imports the JSON files.
+            claimed = self.conn.execute("INSERT OR IGNORE INTO meta VALUES ('json_imported', ?)",
+                                        (datetime.datetime.now(datetime.UTC).isoformat(),)).rowcount
+            if claimed:
+                self.import_json_files()
+        with self.conn:
+            if self.conn.execute("INSERT OR IGNORE INTO meta VALUES ('games_normalized', '1')").rowcount:
+                self.normalize_game_names()
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (self.seq_key,)).fetchone()
+        # Every table commits in the same transaction, so they all cover the same sequence.
+        self.seq = int(row[0]) if row else 0
+
+    def migrate_active_sessions(self):
+        """One-time migration: re-keys active_sessions by (owner, user_id), keeping the rows."""
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")  # Another process may be migrating too
+            columns = {row[1]: row[5] for row in self.conn.execute("PRAGMA table_info(active_sessions)")}
+            if columns.get("owner"): return  # Already part of the primary key
+            owner = "owner" if "owner" in columns else "''"
+            self.conn.execute("CREATE TABLE active_sessions_new (owner TEXT NOT NULL, user_id INTEGER NOT NULL, "
+                              "record TEXT NOT NULL, PRIMARY KEY (owner, user_id))")
+            self.conn.execute(f"INSERT INTO active_sessions_new SELECT {owner}, user_id, record FROM active_sessions")
+            self.conn.execute("DROP TABLE active_sessions")
+            self.conn.execute("ALTER TABLE active_sessions_new RENAME TO active_sessions")
+
+    def import_json_files(self):
+        """
+        One-time migration: copies whatever the JSON backend left in DATA_FOLDER into the
+        database. Runs inside the transaction that claimed the json_imported flag.
+        """
+        play_times = load_data(PLAY_TIMES_FILE)
+        leaderboard = load_data(LEADERBOARD_FILE)
+        roles = load_data(GAME_ROLES_FILE)
+        game_leaderboard = load_data(GAME_LEADERBOARD_FILE)
+        if os.path.isdir(GUILD_DATA_FOLDER):
+            for file_name in os.listdir(GUILD_DATA_FOLDER):
+                guild_id_str, ext = os.path.splitext(file_name)
+                if ext != ".json": continue
+                data = load_data(os.path.join(GUILD_DATA_FOLDER, file_name))
+                leaderboard[guild_id_str] = data.get("users", {})
+                game_leaderboard[guild_id_str] = data.get("games", {})
+                roles[guild_id_str] = data.get("roles", {})
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO active_sessions VALUES (?, ?, ?)",
+            [(self.owner, int(user_id), json.dumps(record)) for user_id, record in play_times.items()])
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO user_playtime VALUES (?, ?, ?)",
+            [(g, u, s) for g, users in leaderboard.items() for u, s in users.items()])
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO game_playtime VALUES (?, ?, ?)",
+            [(g, game, s) for g, games in game_leaderboard.items() for game, s in games.items()])
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO game_roles VALUES (?, ?, ?)",
+            [(g, game, r) for g, links in roles.items() for game, r in links.items()])
+        if play_times or leaderboard or roles or game_leaderboard:
+            print(f"INFO: Imported existing JSON data from '{DATA_FOLDER}' into {SQLITE_DB_FILE}.")
+
+    def normalize_game_names(self):
+        """
+        One-time migration to catalog keys: rows stored under raw spellings are merged under
+        their normalized name, and the first spelling seen becomes the display name.
+        """
+        names, playtime, roles = {}, {}, {}
+        for guild_id_str, game, seconds in self.conn.execute("SELECT guild_id, game, seconds FROM game_playtime"):
+            key = GameCatalog.normalize(game)
+            names.setdefault(key, " ".join(game.split()))
+            playtime[(guild_id_str, key)] = playtime.get((guild_id_str, key), 0) + seconds
+        for guild_id_str, game, role_id in self.conn.execute("SELECT guild_id, game, role_id FROM game_roles"):
+            key = GameCatalog.normalize(game)
+            names.setdefault(key, " ".join(game.split()))
+            roles[(guild_id_str, key)] = role_id
+        self.conn.execute("DELETE FROM game_playtime")
+        self.conn.execute("DELETE FROM game_roles")
+        self.conn.executemany("INSERT INTO game_playtime VALUES (?, ?, ?)",
+                              [(g, key, seconds) for (g, key), seconds in playtime.items()])
+        self.conn.executemany("INSERT INTO game_roles VALUES (?, ?, ?)",
+                              [(g, key, role_id) for (g, key), role_id in roles.items()])
+        self.conn.executemany("INSERT OR IGNORE INTO games VALUES (?, ?)", names.items())
+
+    def load(self):
+        game_catalog.preload(dict(self.conn.execute("SELECT game, name FROM games")))
+        if self.owner:
+            # Sessions left unscoped by a single-process run are adopted by the first lease to start.
+            with self.conn:
+                self.conn.execute("INSERT OR IGNORE INTO active_sessions "
+                                  "SELECT ?, user_id, record FROM active_sessions WHERE owner = ''", (self.owner,))
+                self.conn.execute("DELETE FROM active_sessions WHERE owner = ''")
+        play_times = {str(user_id): json.loads(record) for user_id, record in self.conn.execute(
+            "SELECT user_id, record FROM active_sessions WHERE owner = ?", (self.owner,))}
+        return {"play_times": play_times, "floors": {"play_times": self.seq}}
+
+    def load_guild(self, guild_id_str):
+        users = dict(self.conn.execute(
+            "SELECT user_id, seconds FROM user_playtime WHERE guild_id = ?", (guild_id_str,)))
+        games = dict(self.conn.execute(
+            "SELECT game, seconds FROM game_playtime WHERE guild_id = ?", (guild_id_str,)))
+        roles = dict(self.conn.execute(
+            "SELECT game, role_id FROM game_roles WHERE guild_id = ?", (guild_id_str,)))
+        row = self.conn.execute(
+            "SELECT generation, started, announced, timezone FROM guild_generations WHERE guild_id = ?",
+            (guild_id_str,)).fetchone()
+        return GuildData(users, games, roles, self.seq, *(row or ()))
+
+    def snapshot(self, changes, seq):
+        """Collects the changed rows and returns a job that applies them in one transaction."""
+        resets = list(changes.reset_guilds)
+        user_rows = [(g, u, s) for g, users in changes.user_seconds.items() for u, s in users.items()]
+        game_rows = [(g, game_catalog.key(game_id), s) for (g, game_id), s in changes.game_seconds.items()]
+        role_rows = [(g, game_catalog.key(game_id), guild_cache[g].roles.get(game_id))
+                     for g, game_id in changes.game_roles]
+        catalog_rows = game_catalog.take_unsaved()
+        # Written for every touched guild, so a guild's week start is stored with its first playtime.
+        generation_rows = [(g, guild_cache[g].generation, guild_cache[g].started, guild_cache[g].announced,
+                            guild_cache[g].timezone) for g in changes.guilds]
+        session_rows = []
+        for user_id in changes.sessions:
+            info = playing_start_times.get(user_id)
+            session_rows.append((user_id, json.dumps(info.to_record(), separators=(",", ":")) if info else None))
+
+        def write():
+            with self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (self.seq_key, str(seq)))
+                self.conn.executemany("INSERT OR IGNORE INTO games VALUES (?, ?)", catalog_rows)
+                self.conn.executemany("INSERT OR REPLACE INTO guild_generations VALUES (?, ?, ?, ?, ?)",
+                                      generation_rows)
+                for guild_id_str in resets:
+                    self.conn.execute("DELETE FROM user_playtime WHERE guild_id = ?", (guild_id_str,))
+                    self.conn.execute("DELETE FROM game_playtime WHERE guild_id = ?", (guild_id_str,))
+                self.conn.executemany(
+                    "INSERT INTO user_playtime VALUES (?, ?, ?) "
+                    "ON CONFLICT (guild_id, user_id) DO UPDATE SET seconds = seconds + excluded.seconds",
+                    user_rows)
+                self.conn.executemany(
+                    "INSERT INTO game_playtime VALUES (?, ?, ?) "
+                    "ON CONFLICT (guild_id, game) DO UPDATE SET seconds = seconds + excluded.seconds",
+                    game_rows)
+                for guild_id_str, game, role_id in role_rows:
+                    if role_id is None:
+                        self.conn.execute("DELETE FROM game_roles WHERE guild_id = ? AND game = ?",
+                                          (guild_id_str, game))
+                    else:
+                        self.conn.execute("INSERT OR REPLACE INTO game_roles VALUES (?, ?, ?)",
+                                          (guild_id_str, game, role_id))
+                for user_id, record in session_rows:
+                    if record is None:
+                        self.conn.execute("DELETE FROM active_sessions WHERE owner = ? AND user_id = ?",
+                                          (self.owner, user_id))
+                    else:
+                        self.conn.execute("INSERT OR REPLACE INTO active_sessions VALUES (?, ?, ?)",
+                                          (self.owner, user_id, record))
+        return write
+
+    def acquire_lease(self, name, holder, ttl):
+        """Takes or renews a lease in one statement. Returns True if `holder` now holds it."""
+        now = time.time()
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT (name) DO UPDATE "
+                "SET holder = excluded.holder, expires = excluded.expires "
+                "WHERE leases.holder = excluded.holder OR leases.expires < ?",
+                (name, holder, now + ttl, now))
+            row = self.conn.execute("SELECT holder FROM leases WHERE name = ?", (name,)).fetchone()
+        return row is not None and row[0] == holder
+
+    def lease_holder(self, name):
+        """Who holds or last held a lease, expired or not. None once it was released."""
+        row = self.conn.execute("SELECT holder FROM leases WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def release_lease(self, name, holder):
+        with self.conn:
+            self.conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+
+
+# --- SESSION HISTORY ---
+def split_into_buckets(start, end, size, offset=0):
+    """Yields (bucket_start, seconds) for each fixed-size bucket the span [start, end) touches."""
+    t = start
+    while t < end:
+        bucket = t - (t - offset) % size
+        bucket_end = min(end, bucket + size)
+        yield int(bucket), bucket_end - t
+        t = bucket_end
+
+
+class HistoryStore:
+    """
+    Every finished session, plus rollups that are updated in the same transaction as the
+    insert, so range queries read a handful of pre-summed rows instead of raw sessions.
+    Sessions are keyed by the log event that ended them, which makes replays harmless.
+    Used only from the writer thread.
+    """
+
+    # bucket -> (size in seconds, offset); weeks start on Monday, four days after the epoch.
+    BUCKETS = {"hour": (3600, 0), "day": (86400, 0), "week": (7 * 86400, 4 * 86400)}
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            source TEXT NOT NULL, seq INTEGER NOT NULL, guild_id INTEGER NOT NULL, user_id INTEGER NOT NULL,
+            game TEXT NOT NULL, started REAL NOT NULL, ended REAL NOT NULL,
+            PRIMARY KEY (source, seq));
+        CREATE TABLE IF NOT EXISTS rollups (
+            bucket TEXT NOT NULL, guild_id INTEGER NOT NULL, user_id INTEGER NOT NULL, start INTEGER NOT NULL,
+            game TEXT NOT NULL, seconds REAL NOT NULL,
+            PRIMARY KEY (bucket, guild_id, user_id, start, game)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS rollups_by_guild ON rollups (bucket, guild_id, start);
+    """
+
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=10000")
+        self.conn.executescript(self.SCHEMA)
+        self.pending = []  # Rows for the next write(), filled on the event loop
+
+    def record(self, seq, guild_id, user_id, game_id, started, ended):
+        """Queues a finished session; flush_data() hands the batch to the writer."""
+        if ended > started:
+            self.pending.append((INSTANCE_ID, seq, guild_id, user_id, game_catalog.key(game_id), started, ended))
+
+    def write(self, rows):
+        """Runs on the writer thread: inserts sessions and folds each new one into the rollups."""
+        with self.conn:
+            for row in rows:
+                if not self.conn.execute("INSERT OR IGNORE INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?)", row).rowcount:
+                    continue  # Already recorded before a crash; the log replayed it
+                _, _, guild_id, user_id, game, started, ended = row
+                self.conn.executemany(
+                    "INSERT INTO rollups VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (bucket, guild_id, user_id, start, game) "
+                    "DO UPDATE SET seconds = seconds + excluded.seconds",
+                    [(bucket, guild_id, user_id, start, game, seconds)
+                     for bucket, (size, offset) in self.BUCKETS.items()
+                     for start, seconds in split_into_buckets(started, ended, size, offset)])
+
+    def user_games(self, guild_id, user_id, since):
+        """(game, seconds) for one member since an epoch, most played first."""
+        return self.conn.execute(
+            "SELECT game, SUM(seconds) FROM rollups WHERE bucket = 'day' AND guild_id = ? AND user_id = ? "
+            "AND start >= ? GROUP BY game ORDER BY 2 DESC", (guild_id, user_id, since)).fetchall()
+
+    def top_games(self, guild_id, since, limit=10):
+        """(game, seconds, players) for a guild since an epoch, most played first."""
+        return self.conn.execute(
+            "SELECT game, SUM(seconds), COUNT(DISTINCT user_id) FROM rollups WHERE bucket = 'day' "
+            "AND guild_id = ? AND start >= ? GROUP BY game ORDER BY 2 DESC LIMIT ?",
+            (guild_id, since, limit)).fetchall()
+
+
+class WeekArchive:
+    """
+    Cold storage for finished leaderboard generations. Each guild has an append-only file of
+    concatenated gzip members, one per generation, and a JSON-lines index of their byte
+    offsets, so a single past week is read back without decompressing the others.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.pending = []  # (guild_id_str, record) for the next flush, filled on the event loop
+
+    def paths(self, guild_id_str):
+        base = os.path.join(self.folder, guild_id_str)
+        return base + ".gz", base + ".idx"
+
+    def index(self, guild_id_str):
+        """Archived generations of a guild, oldest first: generation, started, ended, offset, length."""
+        entries = []
+        try:
+            with open(self.paths(guild_id_str)[1], 'r') as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        print(f"Warning: Ignoring a torn line in the archive index of guild {guild_id_str}.")
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def write(self, items):
+        """Runs on the writer thread. Generations that are already archived are skipped."""
+        os.makedirs(self.folder, exist_ok=True)
+        for guild_id_str, record in items:
+            if any(entry["generation"] == record["generation"] for entry in self.index(guild_id_str)):
+                continue
+            blob = gzip.compress(json.dumps(record, separators=(",", ":")).encode("utf-8"))
+            archive_path, index_path = self.paths(guild_id_str)
+            with open(archive_path, 'ab') as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(blob)
+                f.flush()
+                os.fsync(f.fileno())
+            entry = {"generation": record["generation"], "started": record["started"], "ended": record["ended"],
+                     "offset": offset, "length": len(blob)}
+            with open(index_path, 'a') as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def read(self, guild_id_str, generation):
+        """Returns one archived generation, or None."""
+        entry = next((e for e in self.index(guild_id_str) if e["generation"] == generation), None)
+        if entry is None: return None
+        with open(self.paths(guild_id_str)[0], 'rb') as f:
+            f.seek(entry["offset"])
+            return json.loads(gzip.decompress(f.read(entry["length"])))
+
+
+def archived_game_name(key):
+    """Display name for a stored game key, from the history database or the archive."""
+    game_id = game_catalog.lookup(key)
+    return key if game_id is None else game_catalog.name(game_id)
+
+
+def history_since(days):
+    """Epoch of the start of the day `days - 1` days ago (UTC), so "1 day" means today."""
+    days = max(1, min(days, HISTORY_MAX_DAYS))
+    today = time.time() // 86400 * 86400
+    return int(today - (days - 1) * 86400), days
+
+
+def create_storage():
+    """Builds the storage backend selected by STORAGE_BACKEND."""
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteStorage(SQLITE_DB_FILE)
+    if STORAGE_BACKEND != "json":
+        print(f"Warning: Unknown STORAGE_BACKEND '{STORAGE_BACKEND}', falling back to 'json'.")
+    return JsonStorage()
 
 
 # --- BOT INITIALIZATION ---
@@ -66,42 +1488,91 @@ intents.presences = True
 intents.members = True
 intents.message_content = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+# Guilds are chunked by scan_guild() instead, a few at a time, so on_ready fires without waiting on them.
+if SHARDED:
+    bot = commands.AutoShardedBot(command_prefix="!", intents=intents, chunk_guilds_at_startup=False,
+                                  shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents, chunk_guilds_at_startup=False)
+
+shard_events = {}  # shard id -> connection state and counters, fed by the on_shard_* events
+# Shards (re)connected but not yet rescanned. Their sessions may have ended while we weren't
+# watching, so the heartbeat leaves them alone until the scan has stopped them at the right time.
+rescanning_shards = set()
+
+
+def shard_of(guild_id):
+    """The shard a guild lives on, by Discord's (guild_id >> 22) % shard_count rule."""
+    return (int(guild_id) >> 22) % (bot.shard_count or 1)
+
+
+def shard_is_up(shard_id):
+    """True if this process owns the shard and its gateway connection is open."""
+    if not SHARDED: return not bot.is_closed()
+    shard = bot.get_shard(shard_id)
+    return shard is not None and not shard.is_closed()
+
+
+def sessions_by_shard():
+    """Groups active sessions by the shard of their guild."""
+    grouped = {}
+    for user_id, info in playing_start_times.items():
+        grouped.setdefault(shard_of(info.guild_id), []).append((user_id, info))
+    return grouped
+
+
+def shard_stats():
+    """Per-shard health for /metrics: connection state, latency and the load each shard carries."""
+    sessions = sessions_by_shard()
+    shard_ids = sorted(bot.shards) if SHARDED else [0]
+    stats = {}
+    for shard_id in shard_ids:
+        latency = bot.shards[shard_id].latency if SHARDED else bot.latency
+        stats[str(shard_id)] = {
+            "up": shard_is_up(shard_id),
+            "latency": latency if latency < float("inf") else None,
+            "guilds": sum(1 for guild in bot.guilds if shard_of(guild.id) == shard_id),
+            "sessions": len(sessions.get(shard_id, ())),
+            **shard_events.get(shard_id, {}),
+        }
+    return stats
+
+
+def note_shard_event(shard_id, state, counter=None):
+    entry = shard_events.setdefault(shard_id, {"state": None, "since": None, "disconnects": 0, "resumes": 0})
+    entry["state"], entry["since"] = state, time.time()
+    if counter:
+        entry[counter] += 1
 
 # --- DATA LOADING ---
 setup_data_files()
-playing_start_times_raw = load_data(PLAY_TIMES_FILE)
-playing_start_times = {}
-for user_id_str, data in playing_start_times_raw.items():
-    user_id = int(user_id_str)
-    start_time = datetime.datetime.fromisoformat(data["start_time"])
-    playing_start_times[user_id] = {
-        "start_time": start_time,
-        "last_updated": datetime.datetime.fromisoformat(data.get("last_updated", start_time.isoformat())),
-        "game": data["game"],
-        "milestones_hit": set(data.get("milestones_hit", [])),
-        "guild_id": data["guild_id"],
-        "channel_id": data["channel_id"]
-    }
+storage = create_storage()
+session_history = HistoryStore(HISTORY_DB_FILE)
+week_archive = WeekArchive(ARCHIVE_FOLDER)
+stored_data = storage.load()
+playing_start_times = SessionMap({int(user_id_str): ActiveSession.from_record(data)
+                                  for user_id_str, data in stored_data["play_times"].items()})
 
-leaderboard_data = load_data(LEADERBOARD_FILE)
-game_roles = load_data(GAME_ROLES_FILE)
-game_leaderboard_data = load_data(GAME_LEADERBOARD_FILE)
 
-milestone_messages = {
-    60: "⏱️ Wow, such dedication! You've been gaming for 1 hour!",
-    120: "🎮 What a gamer! You've reached 2 hours!",
-    180: "🔥 Batak ampota! 3 hours of solid play!",
-    240: "😳 Are you okay? That’s 4 hours!",
-    300: "👀 This is turning into a marathon. 5 hours and counting!",
-}
+# --- CORE HELPER FUNCTIONS ---
+channel_cache = {}  # guild_id -> {channel_name: channel, or None if the guild has no such channel}
 
 
-# --- CORE HELPER FUNCTIONS ---
 # MODIFIED: Renamed and generalized the function to find any channel by name
 def get_text_channel_by_name(guild, channel_name):
-    """Finds a text channel in a guild by its name."""
-    return discord.utils.get(guild.text_channels, name=channel_name)
+    """
+    Finds a text channel in a guild by its name. Results (including misses) are cached per
+    guild until one of its channels is created, deleted or changed, since this runs on
+    every presence update.
+    """
+    names = channel_cache.setdefault(guild.id, {})
+    if channel_name not in names:
+        names[channel_name] = discord.utils.get(guild.text_channels, name=channel_name)
+    return names[channel_name]
+
+
+def invalidate_channel_cache(guild):
+    channel_cache.pop(guild.id, None)
 
 
 def format_duration(seconds):
@@ -116,47 +1587,524 @@ def format_duration(seconds):
     return f"{int(minutes)}m {int(seconds)}s"
 
 
-async def update_leaderboard(member, duration_seconds):
+def update_leaderboard(guild_id, user_id, duration_seconds):
     """Updates the user leaderboard with playtime."""
     if duration_seconds <= 0: return
-    guild_id_str = str(member.guild.id)
-    user_id_str = str(member.id)
-    if guild_id_str not in leaderboard_data:
-        leaderboard_data[guild_id_str] = {}
-    current_time = leaderboard_data[guild_id_str].get(user_id_str, 0)
-    leaderboard_data[guild_id_str][user_id_str] = current_time + duration_seconds
-    save_data(LEADERBOARD_FILE, leaderboard_data)
+    guild_id_str = str(guild_id)
+    user_id_str = str(user_id)
+    get_guild_data(guild_id_str).users.add(user_id_str, duration_seconds)
+    pending_changes.add_user_seconds(guild_id_str, user_id_str, duration_seconds)
+
+
+def update_leaderboard_many(guild_id_str, amounts):
+    """Updates the user leaderboard with a mapping of user_id_str -> playtime."""
+    get_guild_data(guild_id_str).users.add_many(amounts)
+    pending_changes.add_user_seconds_many(guild_id_str, amounts)
 
 
-async def update_game_leaderboard(guild, game_name, duration_seconds):
+def update_game_leaderboard(guild_id, game_id, duration_seconds):
     """Updates the game leaderboard with playtime."""
     if duration_seconds <= 0: return
-    guild_id_str = str(guild.id)
-    if guild_id_str not in game_leaderboard_data:
-        game_leaderboard_data[guild_id_str] = {}
-    current_time = game_leaderboard_data[guild_id_str].get(game_name, 0)
-    game_leaderboard_data[guild_id_str][game_name] = current_time + duration_seconds
-    save_data(GAME_LEADERBOARD_FILE, game_leaderboard_data)
-
-
-async def handle_game_role(member, game_name, action="add"):
-    """Adds or removes a game-specific role from a member."""
-    guild_id_str = str(member.guild.id)
-    if guild_id_str not in game_roles or not game_name: return
-    game_name_lower = game_name.lower()
-    if game_name_lower in game_roles[guild_id_str]:
-        role_id = game_roles[guild_id_str][game_name_lower]
-        role = member.guild.get_role(role_id)
-        if role:
+    guild_id_str = str(guild_id)
+    get_guild_data(guild_id_str).games.add(game_id, duration_seconds)
+    pending_changes.add_game_seconds(guild_id_str, game_id, duration_seconds)
+
+
+# --- ROLE RECONCILIATION ---
+class RoleReconciler:
+    """
+    Keeps game roles in line with who is playing what. Changes only queue the member; the
+    worker later computes the roles they should hold from playing_start_times and the
+    guild's role links, diffs that against the roles they have and applies the difference
+    in at most one add and one remove call. A flap inside the delay costs nothing.
+    """
+
+    def __init__(self):
+        self.dirty = {}  # guild id -> member ids waiting to be reconciled
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.stats = {"reconciled": 0, "roles_added": 0, "roles_removed": 0, "failures": 0}
+
+    def request(self, member):
+        self.dirty.setdefault(member.guild.id, set()).add(member.id)
+        self.wakeup.set()
+
+    async def request_guild(self, guild):
+        """Queues every member who is playing or holds one of the guild's game roles."""
+        roles = (await load_guild_data(guild.id)).roles
+        member_ids = {user_id for user_id, info in playing_start_times.items() if info.guild_id == guild.id}
+        for role_id in set(roles.values()):
+            role = guild.get_role(role_id)
+            if role:
+                member_ids.update(m.id for m in role.members)
+        if member_ids:
+            self.dirty.setdefault(guild.id, set()).update(member_ids)
+            self.wakeup.set()
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            await asyncio.sleep(ROLE_SYNC_DELAY_SECONDS)  # Let bursts and flaps settle first
+            self.wakeup.clear()
+            dirty, self.dirty = self.dirty, {}
+            if not leader.is_leader:
+                continue  # A standby tracks nothing, so every role would look unwanted
+            await asyncio.gather(*(self.sync_guild(guild_id, ids) for guild_id, ids in dirty.items()))
+
+    async def sync_guild(self, guild_id, member_ids):
+        guild = bot.get_guild(guild_id)
+        if not guild: return
+        roles = (await load_guild_data(guild_id)).roles
+        if not roles: return
+        limit = asyncio.Semaphore(ROLE_SYNC_CONCURRENCY)
+
+        async def sync(member):
+            async with limit:
+                await self.sync_member(member, roles)
+
+        members = [m for m in map(guild.get_member, member_ids) if m]
+        await asyncio.gather(*(sync(member) for member in members))
+
+    async def sync_member(self, member, roles):
+        """Applies the minimal role change for one member."""
+        if not leader.is_leader: return  # Demoted while this guild was being synced
+        managed = set(roles.values())
+        wanted = set()
+        info = playing_start_times.get(member.id)
+        if info and info.guild_id == member.guild.id and info.game_id in roles:
+            wanted.add(roles[info.game_id])
+        held = {role.id for role in member.roles if role.id in managed}
+        to_add = [r for r in map(member.guild.get_role, wanted - held) if r]
+        to_remove = [r for r in map(member.guild.get_role, held - wanted) if r]
+        self.stats["reconciled"] += 1
+        try:
+            if to_add:
+                await member.add_roles(*to_add, reason=f"Playing {info.game}")
+                self.stats["roles_added"] += len(to_add)
+            if to_remove:
+                await member.remove_roles(*to_remove, reason="No longer playing")
+                self.stats["roles_removed"] += len(to_remove)
+        except discord.Forbidden:
+            self.stats["failures"] += 1
+            print(f"Error: Bot lacks permissions to manage game roles for {member.name}.")
+        except discord.HTTPException as e:
+            self.stats["failures"] += 1
+            print(f"Error: An HTTP error occurred while managing roles: {e}")
+
+
+role_reconciler = RoleReconciler()
+
+
+# --- OUTBOUND MESSAGES ---
+outboxes = {}  # channel id -> ChannelOutbox, only while it has something to send
+outbox_stats = {"messages_sent": 0, "lines_sent": 0, "lines_dropped": 0, "send_failures": 0}
+
+
+def pack_lines(lines, limit=MESSAGE_CHAR_LIMIT):
+    """Joins lines into as few messages as possible, each at most `limit` characters."""
+    messages, current = [], ""
+    for line in lines:
+        line = line[:limit]
+        if current and len(current) + 1 + len(line) > limit:
+            messages.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        messages.append(current)
+    return messages
+
+
+class ChannelOutbox:
+    """Collects the lines posted to one channel and sends them in batches."""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.urgent = []
+        self.lines = []
+        self.dropped = 0
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def put(self, text, priority=False):
+        if priority:
+            self.urgent.append(text)
+            self.wakeup.set()
+        elif len(self.lines) < OUTBOX_MAX_LINES:
+            self.lines.append(text)
+        else:
+            self.dropped += 1
+            outbox_stats["lines_dropped"] += 1
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        try:
+            while self.urgent or self.lines or self.dropped:
+                if not self.urgent:
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), PRESENCE_BATCH_SECONDS)
+                    except asyncio.TimeoutError:
+                        pass
+                self.wakeup.clear()
+                # Milestones go first; anything that piled up meanwhile rides along.
+                batch = self.urgent + self.lines
+                outbox_stats["lines_sent"] += len(batch)
+                if self.dropped:
+                    batch.append(f"…and {self.dropped} more updates.")
+                self.urgent, self.lines, self.dropped = [], [], 0
+                for message in pack_lines(batch):
+                    try:
+                        await self.channel.send(message)
+                        outbox_stats["messages_sent"] += 1
+                    except discord.HTTPException as e:
+                        outbox_stats["send_failures"] += 1
+                        print(f"Error: Could not send to #{self.channel.name}: {e}")
+        finally:
+            self.task = None
+            outboxes.pop(self.channel.id, None)
+
+
+def post_message(channel, text, priority=False):
+    """Queues a line for `channel` without waiting on Discord."""
+    outbox = outboxes.get(channel.id)
+    if outbox is None:
+        outbox = outboxes[channel.id] = ChannelOutbox(channel)
+    outbox.put(text, priority)
+
+
+# --- MILESTONE SCHEDULER ---
+class MilestoneScheduler:
+    """Sleeps until the earliest session milestone in a deadline heap. Ended sessions' entries are skipped when popped."""
+
+    RETRY_SECONDS = 60
+
+    def __init__(self):
+        self.heap = []  # (due_epoch, tiebreak, user_id, minutes, session)
+        self.counter = 0
+        self.stale = 0
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def schedule(self, user_id, session, not_before=None):
+        """Queues the session's next unannounced milestone."""
+        minutes = next((m for m in MILESTONE_BITS if not session.has_milestone(m)), None)
+        if minutes is None: return
+        due = session.start_time + minutes * 60
+        if not_before is not None:
+            due = max(due, not_before)
+        self.counter += 1
+        heapq.heappush(self.heap, (due, self.counter, user_id, minutes, session))
+        if self.heap[0][1] == self.counter:
+            self.wakeup.set()  # New earliest deadline: re-arm the sleep
+
+    def cancel(self, user_id):
+        """Called when a session ends. Its heap entry is skipped when it comes due."""
+        self.stale += 1
+        if self.stale > 64 and self.stale > len(self.heap) // 2:
+            self.heap = [entry for entry in self.heap if playing_start_times.get(entry[2]) is entry[4]]
+            heapq.heapify(self.heap)
+            self.stale = 0
+
+    def rebuild(self):
+        self.heap, self.stale = [], 0
+        for user_id, session in playing_start_times.items():
+            self.schedule(user_id, session)
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        self.rebuild()
+        while True:
+            now = time.time()
+            while self.heap and self.heap[0][0] <= now:
+                _, _, user_id, minutes, session = heapq.heappop(self.heap)
+                if playing_start_times.get(user_id) is not session or session.has_milestone(minutes):
+                    continue
+                await self.announce(user_id, session, minutes)
+            self.wakeup.clear()
+            timeout = self.heap[0][0] - time.time() if self.heap else None
             try:
-                if action == "add":
-                    await member.add_roles(role, reason=f"Started playing {game_name}")
-                elif action == "remove":
-                    await member.remove_roles(role, reason=f"Stopped playing {game_name}")
-            except discord.Forbidden:
-                print(f"Error: Bot lacks permissions to manage role '{role.name}' for {member.name}.")
-            except discord.HTTPException as e:
-                print(f"Error: An HTTP error occurred while managing roles: {e}")
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def announce(self, user_id, session, minutes):
+        """
+        Queues a milestone post. If the member is not cached yet, or their session is about
+        to stop, retries a minute later.
+        """
+        guild = bot.get_guild(session.guild_id)
+        # The channel_id stored is the presence channel, which is correct for milestones
+        channel = guild.get_channel(session.channel_id) if guild and session.channel_id else None
+        member = guild.get_member(user_id) if guild else None
+        if not channel:
+            # Nowhere to announce it; record it so the next milestone gets scheduled.
+            record_event("milestone", user=user_id, minutes=minutes)
+            return
+        if not member or presence_debouncer.is_stopping(user_id):
+            self.schedule(user_id, session, not_before=time.time() + self.RETRY_SECONDS)
+            return
+        post_message(channel, f"**{member.mention}** {milestone_messages[minutes]}", priority=True)
+        record_event("milestone", user=user_id, minutes=minutes)
+
+
+milestone_scheduler = MilestoneScheduler()
+
+
+# --- SESSION EVENT LOG ---
+class EventLog:
+    """
+    Append-only log of session events, one JSON line each. Lines are buffered in memory
+    and appended with a single fsync per batch; the log doubles as an audit trail.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.buffer = []
+        self.seq = 0
+        self.tick_bytes = 0  # Size of the latest accrual tick, which scales the compaction threshold
+        # Bytes handed to the writer since the last compaction, tracked here so the
+        # event loop never has to stat the file.
+        try:
+            self.size = os.path.getsize(path)
+        except FileNotFoundError:
+            self.size = 0
+
+    def append(self, event):
+        self.seq += 1
+        event["seq"] = self.seq
+        self.buffer.append(json.dumps(event, separators=(",", ":")))
+
+    def write(self, lines):
+        """Runs on the writer thread: appends a batch of lines with a single fsync."""
+        with open(self.path, 'a') as f:
+            f.write("\n".join(lines) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def rotate(self):
+        """
+        Runs on the writer thread after a snapshot: starts a new segment, keeping the previous
+        SNAPSHOT_GENERATIONS segments for snapshots that have to fall back a generation.
+        """
+        rotate_generations(self.path)
+        with open(self.path, 'w') as f:
+            os.fsync(f.fileno())
+        fsync_directory(os.path.dirname(self.path))
+
+    def read(self, after_seq):
+        """Yields logged events newer than after_seq from all kept segments, oldest first."""
+        for generation in range(SNAPSHOT_GENERATIONS, -1, -1):
+            path = generation_path(self.path, generation)
+            try:
+                with open(path, 'r') as f:
+                    for line in f:
+                        try:
+                            event = json.loads(line)
+                        except json.JSONDecodeError:
+                            print(f"Warning: Ignoring a torn line at the end of {path}.")
+                            break
+                        if event["seq"] > after_seq:
+                            yield event
+            except FileNotFoundError:
+                continue
+
+
+def apply_event(event, floors=None):
+    """
+    Applies one logged event to the in-memory state; during replay, floors skips what a snapshot covers.
+    Returns the finished session for "stop" and "switch" events.
+    """
+    def covered(dataset, guild_id=None):
+        if floors is None: return False
+        if guild_id is not None:
+            return event["seq"] <= get_guild_data(guild_id).floors[dataset]
+        return event["seq"] <= floors.get(dataset, 0)
+
+    kind = event["type"]
+    user_id = event.get("user")
+    now = event["ts"]
+    ended = None
+
+    if event.get("seconds"):
+        if not covered("leaderboard", event["guild"]):
+            update_leaderboard(event["guild"], user_id, event["seconds"])
+        if not covered("game_leaderboard", event["guild"]):
+            update_game_leaderboard(event["guild"], game_catalog.intern(event["played"]), event["seconds"])
+
+    if kind == "start":
+        if covered("play_times") or user_id in playing_start_times: return None
+        playing_start_times[user_id] = ActiveSession(event["guild"], event["channel"],
+                                                     game_catalog.intern(event["game"]), now)
+        milestone_scheduler.schedule(user_id, playing_start_times[user_id])
+        pending_changes.touch_session(user_id)
+    elif kind in ("stop", "switch"):
+        if covered("play_times"): return None
+        ended = playing_start_times.pop(user_id, None)
+        if ended is None: return None
+        ended.last_updated = event.get("at", now)
+        session_history.record(event["seq"], ended.guild_id, user_id, ended.game_id,
+                               ended.start_time, ended.last_updated)
+        milestone_scheduler.cancel(user_id)
+        if kind == "switch":
+            playing_start_times[user_id] = ActiveSession(ended.guild_id, ended.channel_id,
+                                                         game_catalog.intern(event["game"]), now)
+            milestone_scheduler.schedule(user_id, playing_start_times[user_id])
+        pending_changes.touch_session(user_id)
+    elif kind == "heartbeat":
+        info = playing_start_times.get(user_id)
+        if covered("play_times") or info is None: return None
+        info.last_updated = now
+        pending_changes.touch_session(user_id)
+    elif kind == "accrue":
+        # One event credits a batch of a tick: guild -> game -> {"users", "seconds", "total"}.
+        # Each guild's user credits are merged in one go and last_updated is written as a column.
+        credited = []
+        for guild_id_str, games in event["guilds"].items():
+            users_done = covered("leaderboard", guild_id_str)
+            games_done = covered("game_leaderboard", guild_id_str)
+            amounts = {}
+            for game, credits in games.items():
+                if isinstance(credits, dict):
+                    total, users, seconds = credits["total"], credits["users"], credits["seconds"]
+                else:  # Logged before credits were columnar: [[user, seconds], ...]
+                    users, seconds = [user for user, _ in credits], [secs for _, secs in credits]
+                    total = sum(seconds)
+                if not games_done:
+                    update_game_leaderboard(guild_id_str, game_catalog.intern(game), total)
+                if not users_done:
+                    amounts.update((str(user), secs) for user, secs in zip(users, seconds) if secs > 0)
+                credited += users
+            if amounts:
+                update_leaderboard_many(guild_id_str, amounts)
+        if not covered("play_times"):
+            rows = [info.row for info in map(playing_start_times.get, credited) if info is not None]
+            if len(rows) < len(credited):  # Some sessions ended since (only during replay)
+                credited = [user for user in credited if user in playing_start_times]
+            session_table.stamp(rows, now)
+            pending_changes.touch_sessions(credited)
+    elif kind == "milestone":
+        info = playing_start_times.get(user_id)
+        if covered("play_times") or info is None: return None
+        info.add_milestone(event["minutes"])
+        milestone_scheduler.schedule(user_id, info)
+        pending_changes.touch_session(user_id)
+    elif kind == "role":
+        if covered("game_roles", event["guild"]): return None
+        game_id = game_catalog.intern(event["game"])
+        get_guild_data(event["guild"]).roles[game_id] = event["role"]
+        pending_changes.touch_game_role(event["guild"], game_id)
+    elif kind == "reset":
+        # A rollover: archive the finished generation and swap in empty leaderboards.
+        guild_id_str = event["guild"]
+        data = get_guild_data(guild_id_str)
+        users_done = covered("leaderboard", guild_id_str)
+        games_done = covered("game_leaderboard", guild_id_str)
+        if users_done and games_done: return None
+        if not users_done:
+            week_archive.pending.append((guild_id_str, data.generation_record(now)))
+            data.users = RankedIndex()
+            data.generation = event.get("generation", data.generation + 1)  # Older logs carry no number
+            data.started = now
+            if event.get("silent"):
+                data.announced = data.generation - 1
+        if not games_done:
+            data.games = RankedIndex()
+        pending_changes.reset_guild(guild_id_str)
+    elif kind == "timezone":
+        guild_id_str = event["guild"]
+        if covered("leaderboard", guild_id_str): return None
+        get_guild_data(guild_id_str).timezone = event["timezone"]
+        pending_changes.touch_generation(guild_id_str)
+    elif kind == "announced":
+        guild_id_str = event["guild"]
+        if covered("leaderboard", guild_id_str): return None
+        data = get_guild_data(guild_id_str)
+        data.announced = max(data.announced, event["generation"])
+        pending_changes.touch_generation(guild_id_str)
+    return ended
+
+
+def record_event(kind, **fields):
+    """Logs an event and applies it to the in-memory state."""
+    now = time.time()
+    event = {"type": kind, "ts": now, **fields}
+    if kind in ("stop", "switch", "heartbeat"):
+        # Credit the playtime since the last update explicitly, so replay needs no session state.
+        info = playing_start_times[fields["user"]]
+        end = fields.get("at", now)
+        event.update(guild=info.guild_id, played=info.game, seconds=max(0.0, end - info.last_updated))
+    elif kind == "accrue":
+        # The tick's credits come straight off the columnar session table, logged in bounded
+        # batches that all carry the tick's timestamp.
+        skip_users, skip_shards = event.pop("skip_users"), event.pop("skip_shards")
+        first_line = len(event_log.buffer)
+        batches = session_table.credits(now, skip_users, skip_shards, bot.shard_count or 1, ACCRUE_BATCH_CREDITS)
+        for guilds in batches[:-1]:
+            batch = {"type": kind, "ts": now, "guilds": guilds}
+            event_log.append(batch)
+            apply_event(batch)
+        event["guilds"] = batches[-1] if batches else {}
+    event_log.append(event)
+    if kind == "accrue":
+        event_log.tick_bytes = sum(len(line) + 1 for line in event_log.buffer[first_line:])
+    ended = apply_event(event)
+    mark_dirty()
+    return ended
+
+
+replay_position = None  # Sequence of the event being replayed at startup, if any
+
+
+def replay_event_log(floors):
+    """Rebuilds the state logged after each dataset's snapshot. Returns the number of events replayed."""
+    global replay_position
+    event_log.seq = max(floors.values(), default=0)
+    replayed = 0
+    for event in event_log.read(min(floors.values(), default=0)):
+        replay_position = event["seq"]  # A guild recovered now only catches up to here
+        apply_event(event, floors)
+        event_log.seq = max(event_log.seq, event["seq"])
+        replayed += 1
+    replay_position = None
+    return replayed
+
+
+def discard_event_log(floors):
+    """Skips the logged events instead of replaying them. Returns how many there were."""
+    event_log.seq = max(floors.values(), default=0)
+    discarded = 0
+    for event in event_log.read(event_log.seq):
+        event_log.seq = max(event_log.seq, event["seq"])
+        discarded += 1
+    return discarded
+
+
+event_log = EventLog(EVENT_LOG_FILE)
+# With several processes, this log is only ours to replay if no other instance has held the
+# lease since: a new leader took the sessions over from the store and credits them itself.
+# Holding the lease through the replay keeps anyone from taking over until it is pushed.
+owns_event_log = (not INSTANCE_ID or storage.lease_holder(LEASE_NAME) == INSTANCE_ID
+                  and storage.acquire_lease(LEASE_NAME, INSTANCE_ID, LEASE_SECONDS))
+if owns_event_log:
+    replayed_events = replay_event_log(stored_data["floors"])
+    if replayed_events:
+        print(f"INFO: Replayed {replayed_events} logged events on top of the last snapshot.")
+else:
+    discarded_events = discard_event_log(stored_data["floors"])
+    if discarded_events:
+        print(f"INFO: Skipped {discarded_events} logged events; another instance has led {LEASE_NAME} since.")
+        compact_data()  # Record them as covered so no later start replays them
+if pending_changes:
+    # Fold replayed or migrated state into a fresh snapshot as soon as the writer starts.
+    compact_data()
 
 
 # --- ACTIVITY TRACKING LOGIC ---
@@ -165,267 +2113,678 @@ async def start_tracking_activity(member, game):
     if member.id in playing_start_times: return
     # MODIFIED: Get the specific presence channel
     channel = get_text_channel_by_name(member.guild, PRESENCE_CHANNEL_NAME)
-    now = datetime.datetime.now(datetime.UTC)
-
-    playing_start_times[member.id] = {
-        "start_time": now,
-        "last_updated": now,
-        "game": game.name,
-        "milestones_hit": set(),
-        "guild_id": member.guild.id,
-        "channel_id": channel.id if channel else None # Store the presence channel ID
-    }
-    save_data(PLAY_TIMES_FILE, playing_start_times)
-    await handle_game_role(member, game.name, action="add")
+
+    await load_guild_data(member.guild.id)
+    record_event("start", user=member.id, guild=member.guild.id, game=game.name,
+                 channel=channel.id if channel else None)  # Store the presence channel ID
+    role_reconciler.request(member)
     print(f"INFO: Started tracking {member.name} playing {game.name}")
     if channel:
-        await channel.send(f"🎮 {member.name} started playing **{game.name}**!")
+        post_message(channel, f"🎮 {member.name} started playing **{game.name}**!")
 
 
-async def stop_tracking_activity(member):
-    """Handles all logic for when a member stops a game, returning the session info."""
+async def stop_tracking_activity(member, at=None):
+    """
+    Handles all logic for when a member stops a game, returning the session info.
+    `at` backdates the stop, so a debounced stop only credits time up to when it was seen.
+    """
     if member.id not in playing_start_times:
         return None, None
 
-    start_info = playing_start_times.pop(member.id)
-    now = datetime.datetime.now(datetime.UTC)
-
-    duration_since_last_update = (now - start_info["last_updated"]).total_seconds()
-    await update_leaderboard(member, duration_since_last_update)
-    await update_game_leaderboard(member.guild, start_info["game"], duration_since_last_update)
-
-    await handle_game_role(member, start_info["game"], action="remove")
-    save_data(PLAY_TIMES_FILE, playing_start_times)
+    if at is None:
+        start_info = record_event("stop", user=member.id)
+    else:
+        start_info = record_event("stop", user=member.id, at=at)
+    role_reconciler.request(member)
 
-    total_duration = (now - start_info["start_time"]).total_seconds()
+    total_duration = start_info.last_updated - start_info.start_time
     print(f"INFO: Stopped tracking {member.name}. Total session time: {format_duration(total_duration)}")
     return start_info, total_duration
 
 
+async def switch_tracking_activity(member, game):
+    """Handles a member switching straight from one game to another as a single logged event."""
+    if member.id not in playing_start_times:
+        await start_tracking_activity(member, game)
+        return
+
+    start_info = record_event("switch", user=member.id, game=game.name)
+    role_reconciler.request(member)
+    print(f"INFO: {member.name} switched from {start_info.game} to {game.name}")
+
+
+# --- PRESENCE DEBOUNCING ---
+class PendingStop:
+    __slots__ = ("game_id", "at", "channel", "task")
+
+    def __init__(self, game_id, at, channel):
+        self.game_id = game_id
+        self.at = at
+        self.channel = channel
+        self.task = None
+
+
+class PresenceDebouncer:
+    """
+    Per-member transition state machine: playing -> stopping -> stopped. A stop waits out
+    PRESENCE_GRACE_SECONDS in the stopping state; if the same game comes back meanwhile the
+    session carries on as if the flap never happened, with no log events, role changes or
+    messages. Offline notices are held the same way and dropped if the member returns.
+    """
+
+    def __init__(self):
+        self.stopping = {}  # user id -> PendingStop
+        self.going_offline = {}  # user id -> task posting the offline notice
+
+    def is_stopping(self, user_id):
+        return user_id in self.stopping
+
+    def hold_stop(self, member, channel, at=None):
+        """Moves a playing member into the stopping state. `at` is when the stop happened, default now."""
+        if member.id not in playing_start_times or member.id in self.stopping: return
+        pending = PendingStop(playing_start_times[member.id].game_id, at or time.time(), channel)
+        pending.task = asyncio.create_task(self.stop_after_grace(member))
+        self.stopping[member.id] = pending
+
+    async def stop_after_grace(self, member):
+        await asyncio.sleep(PRESENCE_GRACE_SECONDS)
+        await self.commit_stop(member)
+
+    async def commit_stop(self, member):
+        """Ends a held session now, crediting playtime only up to when the stop was seen."""
+        pending = self.stopping.pop(member.id, None)
+        if pending is None: return
+        if pending.task is not asyncio.current_task():
+            pending.task.cancel()
+        start_info, duration = await stop_tracking_activity(member, at=pending.at)
+        if pending.channel and start_info:
+            post_message(pending.channel,
+                         f"⏹️ {member.name} stopped playing **{start_info.game}** after {format_duration(duration)}.")
+
+    def resume(self, member, game_name):
+        """Cancels a held stop if the member is back on the same game. Returns True if merged."""
+        pending = self.stopping.get(member.id)
+        if pending is None or pending.game_id != game_catalog.lookup(game_name): return False
+        del self.stopping[member.id]
+        pending.task.cancel()
+        print(f"INFO: {member.name} resumed {game_name} within the grace window; session continues.")
+        return True
+
+    def went_offline(self, member, channel):
+        if member.id in self.going_offline: return
+        self.going_offline[member.id] = asyncio.create_task(self.offline_after_grace(member, channel))
+
+    async def offline_after_grace(self, member, channel):
+        await asyncio.sleep(PRESENCE_GRACE_SECONDS)
+        del self.going_offline[member.id]
+        post_message(channel, f"⚫ {member.mention} just went offline.")
+
+    def came_online(self, member):
+        """Returns True if this cancelled a pending offline notice, i.e. the member only flapped."""
+        task = self.going_offline.pop(member.id, None)
+        if task is None: return False
+        task.cancel()
+        return True
+
+
+presence_debouncer = PresenceDebouncer()
+
+
+# --- PRESENCE PIPELINE ---
+class PresenceChange:
+    """
+    A presence update reduced to what tracking needs. A scan change carries only the member:
+    the worker reconciles tracking with whatever the member's presence is by then.
+    """
+    __slots__ = ("member", "before_status", "after_status", "before_game", "after_game", "scan")
+
+    def __init__(self, member, before_status=None, after_status=None, before_game=None, after_game=None,
+                 scan=False):
+        self.member = member  # The cached member; later updates mutate it, so statuses are copied
+        self.before_status = before_status
+        self.after_status = after_status
+        self.before_game = before_game
+        self.after_game = after_game
+        self.scan = scan
+
+
+class PresencePipeline:
+    """
+    Worker pool for presence changes. A member's changes always go to the same worker's
+    bounded queue, so they are handled one at a time and in arrival order, while different
+    members proceed in parallel and a slow call only holds up its own worker.
+    """
+
+    def __init__(self, workers):
+        self.queues = [asyncio.Queue(maxsize=PRESENCE_QUEUE_SIZE) for _ in range(workers)]
+        self.tasks = []
+        self.processed = 0
+        self.failed = 0
+        self.peak_depth = 0
+
+    def start(self):
+        if self.tasks: return
+        self.tasks = [asyncio.create_task(self.run(q)) for q in self.queues]
+
+    async def submit(self, change):
+        """Queues a change on its member's worker, waiting while that queue is full."""
+        queue_ = self.queues[change.member.id % len(self.queues)]
+        await queue_.put(change)
+        self.peak_depth = max(self.peak_depth, queue_.qsize())
+
+    async def run(self, queue_):
+        while True:
+            change = await queue_.get()
+            try:
+                await process_presence_change(change)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"Error: Could not process presence update for {change.member.name}: {e!r}")
+            finally:
+                queue_.task_done()
+
+    def stats(self):
+        return {"queue_depths": [q.qsize() for q in self.queues], "queue_capacity": PRESENCE_QUEUE_SIZE,
+                "peak_depth": self.peak_depth, "processed": self.processed, "failed": self.failed}
+
+
+async def process_presence_change(change):
+    """Runs on a pipeline worker: applies one member's presence change."""
+    if change.scan:
+        return await reconcile_member(change.member)
+    member, before_game, after_game = change.member, change.before_game, change.after_game
+    before_status, after_status = change.before_status, change.after_status
+    # MODIFIED: Get the specific presence channel for all real-time updates
+    channel = get_text_channel_by_name(member.guild, PRESENCE_CHANNEL_NAME)
+
+    if before_status != after_status and channel:
+        if after_status == discord.Status.online and before_status == discord.Status.offline:
+            if not presence_debouncer.came_online(member):
+                post_message(channel, f"🟢 {member.mention} just came online.")
+        elif after_status == discord.Status.offline:
+            presence_debouncer.went_offline(member, channel)
+
+    if not before_game and after_game:
+        if presence_debouncer.resume(member, after_game.name): return
+        await presence_debouncer.commit_stop(member)
+        await start_tracking_activity(member, after_game)
+    elif (before_game and not after_game) or (before_game and after_status == discord.Status.offline):
+        presence_debouncer.hold_stop(member, channel)
+    elif (before_game and after_game
+          and GameCatalog.normalize(before_game.name) != GameCatalog.normalize(after_game.name)):
+        # Compared as catalog keys: "VALORANT" -> "valorant" is the same game, not a switch.
+        await presence_debouncer.commit_stop(member)
+        await switch_tracking_activity(member, after_game)
+        if channel:
+            post_message(channel, f"🔄 {member.name} switched from **{before_game.name}** to **{after_game.name}**!")
+
+
+async def reconcile_member(member):
+    """
+    Runs on a pipeline worker for scan_guild(): starts, switches, resumes or stops the
+    member's session to match their current presence.
+    """
+    if not leader.is_leader: return  # Demoted since the scan queued it
+    info = playing_start_times.get(member.id)
+    if info and info.guild_id != member.guild.id: return  # Tracked through another guild
+    channel = get_text_channel_by_name(member.guild, PRESENCE_CHANNEL_NAME)
+
+    game_activity = next((a for a in member.activities if a.type == discord.ActivityType.playing), None)
+    if game_activity is None:
+        if info:
+            # Stopped while we were not watching; credit only the time we saw.
+            presence_debouncer.hold_stop(member, channel, at=info.last_updated)
+    elif info is None:
+        print(f"  -> Found {member.name} playing {game_activity.name}. Starting tracking.")
+        await start_tracking_activity(member, game_activity)
+    elif not presence_debouncer.resume(member, game_activity.name) and info.game_id != game_catalog.lookup(game_activity.name):
+        await presence_debouncer.commit_stop(member)
+        await switch_tracking_activity(member, game_activity)
+
+
+presence_pipeline = PresencePipeline(PRESENCE_WORKERS)
+
+
+# --- LEADER ELECTION ---
+class LeaderLease:
+    """
+    Lease-based leader election through the shared store. The holder renews its row every
+    LEASE_SECONDS / 3; if it stops renewing, a standby takes over once the lease expires.
+    Only the leader tracks presences, answers commands and runs the periodic jobs. Without
+    INSTANCE_ID the process is simply always the leader.
+    """
+
+    def __init__(self):
+        self.is_leader = not INSTANCE_ID
+        self.task = None
+
+    def start(self):
+        if INSTANCE_ID and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            try:
+                held = await writer.call(storage.acquire_lease, LEASE_NAME, INSTANCE_ID, LEASE_SECONDS)
+            except sqlite3.Error as e:
+                print(f"Error: Could not renew the {LEASE_NAME} lease: {e}")
+                held = False
+            if held and not self.is_leader:
+                await self.promote()
+            elif not held and self.is_leader:
+                self.demote()
+            await asyncio.sleep(LEASE_SECONDS / 3)
+
+    async def promote(self):
+        """Takes over the sessions the previous leader left in the store, then rescans."""
+        print(f"INFO: Instance {INSTANCE_ID} is now the leader for {LEASE_NAME}.")
+        compact_data(block=True)
+        stored = await writer.call(storage.load)
+        playing_start_times.clear()
+        playing_start_times.update({int(user_id_str): ActiveSession.from_record(data)
+                                    for user_id_str, data in stored["play_times"].items()})
+        guild_cache.clear()  # The previous leader changed these since we last read them
+        milestone_scheduler.rebuild()
+        self.is_leader = True
+        if background_started:
+            await asyncio.gather(*(scan_guild(guild) for guild in bot.guilds))
+            job_scheduler.run_soon("weekly")  # Catch up a rollover the old leader missed
+
+    def demote(self):
+        """Hands everything to the store and stops tracking until the lease is won back."""
+        print(f"Warning: Instance {INSTANCE_ID} lost the {LEASE_NAME} lease; standing by.")
+        self.is_leader = False
+        compact_data(block=True)
+        playing_start_times.clear()
+        guild_cache.clear()
+        milestone_scheduler.rebuild()
+
+
+leader = LeaderLease()
+if not leader.is_leader:
+    # Stand by until elected. Anything replayed above is already queued for the store.
+    playing_start_times.clear()
+
+
+@bot.check
+async def only_leader(ctx):
+    """Standby processes stay silent so every command is answered once."""
+    return leader.is_leader
+
+
 # --- BOT EVENTS ---
+guild_chunk_limit = asyncio.Semaphore(GUILD_CHUNK_CONCURRENCY)
+background_started = False
+
+
+def start_background_tasks():
+    """Starts the web server, workers and loops. on_ready fires on every reconnect, so this runs once."""
+    global background_started
+    if background_started: return
+    background_started = True
+
+    # Start the keep-alive server
+    bot.loop.create_task(keep_alive())
+
+    milestone_scheduler.start()
+    role_reconciler.start()
+    job_scheduler.start()
+
+
+async def scan_guild(guild):
+    """
+    Brings tracking in line with the guild's cached presences: starts sessions for members
+    found playing, switches changed games, and stops sessions whose member no longer plays.
+    Each member is reconciled on their pipeline worker, in order with their presence updates.
+    Returns the number of members found playing.
+    """
+    if not leader.is_leader: return 0
+    if not guild.chunked:
+        async with guild_chunk_limit:
+            try:
+                await guild.chunk(cache=True)
+            except (asyncio.TimeoutError, discord.HTTPException) as e:
+                print(f"Warning: Could not chunk members of {guild.name}, scanning the cached ones: {e}")
+
+    playing = 0
+    for member in guild.members:
+        if member.bot: continue
+        is_playing = any(a.type == discord.ActivityType.playing for a in member.activities)
+        if is_playing or member.id in playing_start_times:
+            await presence_pipeline.submit(PresenceChange(member, scan=True))
+            playing += is_playing
+    await role_reconciler.request_guild(guild)  # Catch up on role changes missed while offline
+    return playing
+
+
 @bot.event
 async def on_ready():
-    """Called when the bot is ready and connected."""
+    """Called when the bot is ready and connected, and again after every reconnect."""
     print(f"✅ Bot is online as {bot.user}")
     print("-" * 20)
+    shard_ids = range(bot.shard_count or 1)
+    rescanning_shards.update(shard_ids)
+    start_background_tasks()
 
-    print("⏳ Waiting 10 seconds for presence cache to populate...")
-    await asyncio.sleep(10)
-    print("✅ Cache ready.")
+    print("🚀 Scanning presences for ongoing activities...")
+    try:
+        started = await asyncio.gather(*(scan_guild(guild) for guild in bot.guilds))
+    finally:
+        rescanning_shards.difference_update(shard_ids)
+    print(f"✅ Scan complete. Found {sum(started)} active users.")
+    print("-" * 20)
 
-    print("🚀 Performing initial presence scan for ongoing activities...")
-    active_users_found = 0
-    for guild in bot.guilds:
-        async for member in guild.fetch_members(limit=None):
-            if member.bot:
-                continue
 
-            game_activity = next((a for a in member.activities if a.type == discord.ActivityType.playing), None)
-            if game_activity and member.id not in playing_start_times:
-                print(f"  -> Found {member.name} playing {game_activity.name}. Starting tracking.")
-                await start_tracking_activity(member, game_activity)
-                active_users_found += 1
+@bot.event
+async def on_shard_connect(shard_id):
+    note_shard_event(shard_id, "connected")
 
-    print(f"✅ Initial scan complete. Found and started tracking {active_users_found} active users.")
-    print("-" * 20)
 
-    # Start the keep-alive server
-    bot.loop.create_task(keep_alive())
+@bot.event
+async def on_shard_disconnect(shard_id):
+    note_shard_event(shard_id, "disconnected", "disconnects")
+    rescanning_shards.add(shard_id)  # Until it resumes or is rescanned
+
 
-    check_milestones.start()
-    update_leaderboards_periodically.start()
-    weekly_reset_and_announce.start()
+@bot.event
+async def on_shard_resumed(shard_id):
+    note_shard_event(shard_id, "ready", "resumes")
+    rescanning_shards.discard(shard_id)  # A resume replays the missed presence updates
 
 
 @bot.event
-async def on_presence_update(before, after):
-    if after.bot: return
+async def on_shard_ready(shard_id):
+    note_shard_event(shard_id, "ready")
+    if background_started:
+        # A shard re-identified after startup: rescan just its guilds for what changed meanwhile.
+        rescanning_shards.add(shard_id)
+        try:
+            await asyncio.gather(*(scan_guild(guild) for guild in bot.guilds if shard_of(guild.id) == shard_id))
+        finally:
+            rescanning_shards.discard(shard_id)
 
-    # MODIFIED: Get the specific presence channel for all real-time updates
-    channel = get_text_channel_by_name(after.guild, PRESENCE_CHANNEL_NAME)
 
-    if before.status != after.status and channel:
-        if after.status == discord.Status.online and before.status == discord.Status.offline:
-            await channel.send(f"🟢 {after.mention} just came online.")
-        elif after.status == discord.Status.offline:
-            await channel.send(f"⚫ {after.mention} just went offline.")
+@bot.event
+async def on_command_error(ctx, error):
+    if isinstance(error, commands.CheckFailure) and not leader.is_leader:
+        return  # The leader answers this one
+    await commands.Bot.on_command_error(bot, ctx, error)
+
+
+@bot.event
+async def on_guild_join(guild):
+    await scan_guild(guild)
+
 
+@bot.event
+async def on_presence_update(before, after):
+    if after.bot or not leader.is_leader: return
     before_game = next((a for a in before.activities if a.type == discord.ActivityType.playing), None)
     after_game = next((a for a in after.activities if a.type == discord.ActivityType.playing), None)
+    if before.status == after.status and getattr(before_game, "name", None) == getattr(after_game, "name", None):
+        return  # Nothing we track changed (custom status, Spotify, ...)
+    await presence_pipeline.submit(PresenceChange(after, before.status, after.status, before_game, after_game))
 
-    if not before_game and after_game:
-        await start_tracking_activity(after, after_game)
-    elif (before_game and not after_game) or (before_game and after.status == discord.Status.offline):
-        start_info, duration = await stop_tracking_activity(after)
-        if channel and start_info:
-            await channel.send(
-                f"⏹️ {after.name} stopped playing **{start_info['game']}** after {format_duration(duration)}.")
-    elif before_game and after_game and before_game.name != after_game.name:
-        await stop_tracking_activity(after)
-        await start_tracking_activity(after, after_game)
-        if channel:
-            await channel.send(f"🔄 {after.name} switched from **{before_game.name}** to **{after_game.name}**!")
+
+@bot.event
+async def on_guild_channel_create(channel):
+    invalidate_channel_cache(channel.guild)
+
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    invalidate_channel_cache(channel.guild)
+
+
+@bot.event
+async def on_guild_channel_update(before, after):
+    invalidate_channel_cache(after.guild)
+
+
+@bot.event
+async def on_guild_remove(guild):
+    invalidate_channel_cache(guild)
 
 
 # --- BACKGROUND TASKS ---
-@tasks.loop(minutes=5)
+class JobScheduler:
+    """Runs the periodic jobs from one timer, each run as its own task. A job returns when it wants to run next."""
+
+    def __init__(self):
+        self.jobs = {}  # name -> (coroutine function, interval seconds)
+        self.due = {}  # name -> epoch of the next run
+        self.running = {}  # name -> task of the run in progress
+        self.rerun = set()  # names asked to run again while running
+        self.stats = {}  # name -> runs, failures, last_seconds
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def add(self, name, fn, interval):
+        """Registers a job. It first runs as soon as the scheduler starts."""
+        self.jobs[name] = (fn, interval)
+        self.due[name] = 0
+        self.stats[name] = {"runs": 0, "failures": 0, "last_seconds": 0.0}
+
+    def run_soon(self, name):
+        """Runs a job right away, or again as soon as its current run finishes."""
+        self.due[name] = 0
+        if name in self.running:
+            self.rerun.add(name)
+        self.wakeup.set()
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            now = time.time()
+            for name, at in self.due.items():
+                if at <= now and name not in self.running:
+                    self.running[name] = asyncio.create_task(self.run_job(name))
+            waiting = [at for name, at in self.due.items() if name not in self.running]
+            timeout = max(0.0, min(waiting) - time.time()) if waiting else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run_job(self, name):
+        fn, interval = self.jobs[name]
+        stats = self.stats[name]
+        began = time.monotonic()
+        try:
+            next_at = await fn()
+        except Exception as e:
+            stats["failures"] += 1
+            print(f"Error: Scheduled job {name} failed: {e}")
+            next_at = None
+        stats["runs"] += 1
+        stats["last_seconds"] = round(time.monotonic() - began, 3)
+        if next_at is None:
+            # Keep a fixed rate, but don't replay every tick missed while the process was paused.
+            next_at = self.due[name] + interval
+            if next_at <= time.time():
+                next_at = time.time() + interval
+        if name in self.rerun:
+            self.rerun.discard(name)
+            next_at = 0
+        self.due[name] = next_at
+        del self.running[name]
+        self.wakeup.set()  # Re-arm the sleep for the new due time
+
+    def status(self):
+        now = time.time()
+        return {name: dict(self.stats[name], due_in=round(max(0.0, self.due[name] - now), 1)) for name in self.jobs}
+
+
+job_scheduler = JobScheduler()
+
+
 async def update_leaderboards_periodically():
     """Periodically saves playtime for active users to prevent data loss."""
-    now = datetime.datetime.now(datetime.UTC)
-    if not playing_start_times: return
+    if not playing_start_times or not leader.is_leader: return
 
     print(f"LOG: [{datetime.datetime.now()}] Running periodic leaderboard update...")
-    for user_id, info in list(playing_start_times.items()):
-        guild = bot.get_guild(info["guild_id"])
-        if not guild: continue
-        member = guild.get_member(user_id)
-        if not member: continue
+    # Sessions on a shard that is down, not yet rescanned, or owned by another process are left
+    # alone; the first heartbeat after its rescan credits whatever of the gap was really played.
+    down_shards = [shard_id for shard_id in range(bot.shard_count or 1)
+                   if not shard_is_up(shard_id) or shard_id in rescanning_shards]
+    # A held stop credits time up to when it was seen; accruing past that would double count.
+    stopping = list(presence_debouncer.stopping)
+
+    # The whole tick is logged in a few bounded batches, applied in a single pass and flushed once.
+    record_event("accrue", skip_users=stopping, skip_shards=down_shards)
+    flush_data()
+    print("LOG: Periodic leaderboard update complete.")
 
-        duration_to_log = (now - info["last_updated"]).total_seconds()
-        await update_leaderboard(member, duration_to_log)
-        await update_game_leaderboard(guild, info["game"], duration_to_log)
 
-        playing_start_times[user_id]["last_updated"] = now
-
-    save_data(PLAY_TIMES_FILE, playing_start_times)
-    print("LOG: Periodic leaderboard update complete.")
+def weekly_embed(guild, record):
+    """The winners announcement for one archived generation."""
+    sorted_users = heapq.nlargest(3, record["users"].items(), key=lambda item: item[1])
+    sorted_games = heapq.nlargest(1, record["games"].items(), key=lambda item: item[1])
 
+    embed = discord.Embed(
+        title="🏆 The Weekly Grind is Over! 🏆",
+        description="The dust has settled on another epic week of gaming! A huge congratulations to this week's champions. **The leaderboards have been archived and a fresh week has begun!**",
+        color=discord.Color.gold(),
+        timestamp=datetime.datetime.now(datetime.UTC)
+    )
+    # NEW: Fixed thumbnail with a direct image link
+    embed.set_thumbnail(url="https://i.imgur.com/rXf2z2i.png")
+
+    if sorted_users:
+        top_user_id_str, top_user_seconds = sorted_users[0]
+        top_user = guild.get_member(int(top_user_id_str))
+        top_user_mention = top_user.mention if top_user else f"User ({top_user_id_str})"
+        embed.add_field(
+            name="👑 Weekly Gaming Champion",
+            value=f"{top_user_mention}\n**Time Played:** `{format_duration(top_user_seconds)}`",
+            inline=True
+        )
+    else:
+        embed.add_field(name="👑 Weekly Gaming Champion", value="*No one played this week!*", inline=True)
+
+    if sorted_games:
+        top_game_key, top_game_seconds = sorted_games[0]
+        top_game_name = archived_game_name(top_game_key)
+        embed.add_field(
+            name="🎮 Most Dominant Game",
+            value=f"**{top_game_name}**\n**Total Playtime:** `{format_duration(top_game_seconds)}`",
+            inline=True
+        )
+    else:
+        embed.add_field(name="🎮 Most Dominant Game", value="*No games were tracked!*", inline=True)
 
-@tasks.loop(minutes=1)
-async def check_milestones():
-    """Checks for and announces playtime milestones."""
-    now = datetime.datetime.now(datetime.UTC)
-    for user_id, info in list(playing_start_times.items()):
-        total_minutes_played = int((now - info["start_time"]).total_seconds() // 60)
-
-        for milestone_minutes, message in milestone_messages.items():
-            if total_minutes_played >= milestone_minutes and milestone_minutes not in info["milestones_hit"]:
-                guild = bot.get_guild(info["guild_id"])
-                if guild:
-                    member = guild.get_member(user_id)
-                    # The channel_id stored is the presence channel, which is correct for milestones
-                    channel = guild.get_channel(info["channel_id"])
-                    if member and channel:
-                        try:
-                            await channel.send(f"**{member.mention}** {message}")
-                            playing_start_times[user_id]["milestones_hit"].add(milestone_minutes)
-                        except discord.HTTPException as e:
-                            print(f"Error: Could not send milestone message: {e}")
+    if len(sorted_users) > 1:
+        embed.add_field(name='\u200b', value='\u200b', inline=False)
+        honorable_mentions = []
+        for i, (user_id_str, total_seconds) in enumerate(sorted_users[1:3], start=2):
+            member = guild.get_member(int(user_id_str))
+            name = member.display_name if member else f"User ({user_id_str})"
+            emoji = "🥈" if i == 2 else "🥉"
+            honorable_mentions.append(f"{emoji} **{name}**: `{format_duration(total_seconds)}`")
+        embed.add_field(name="🏅 Hall of Fame", value="\n".join(honorable_mentions), inline=False)
 
-    if any(info["milestones_hit"] for info in playing_start_times.values()):
-        save_data(PLAY_TIMES_FILE, playing_start_times)
+    embed.set_footer(text="A new week begins now. Good luck, everyone!")
+    return embed
 
 
-@tasks.loop(hours=24)
 async def weekly_reset_and_announce():
     """
-    Checks daily if it's the reset day (Monday). If so, announces winners
-    and resets leaderboards for the new week.
+    Rolls over every guild whose leaderboards started before its most recent local Monday
+    00:00 and announces the winners from the archive. The week's start is persisted with
+    the leaderboards, so a rollover missed while the bot was down happens on the next run
+    and one that already happened is never repeated. Returns when the next one is due.
     """
-    if datetime.datetime.now(datetime.UTC).weekday() != 0:
-        return
-
-    print("--- RUNNING WEEKLY LEADERBOARD RESET ---")
+    if not leader.is_leader:
+        return None
 
+    now = time.time()
+    next_at = None
+    to_announce = []
     for guild in bot.guilds:
-        print(f"Processing reset for guild: {guild.name} ({guild.id})")
         guild_id_str = str(guild.id)
         # MODIFIED: Get the specific weekly announcement channel
         announcement_channel = get_text_channel_by_name(guild, WEEKLY_ANNOUNCEMENT_CHANNEL_NAME)
 
         if not announcement_channel:
-            print(f"  -> Skipping guild {guild.name}, no '{WEEKLY_ANNOUNCEMENT_CHANNEL_NAME}' channel found.")
             continue
 
-        user_lb = leaderboard_data.get(guild_id_str, {})
-        sorted_users = sorted(user_lb.items(), key=lambda i: i[1], reverse=True)
-
-        game_lb = game_leaderboard_data.get(guild_id_str, {})
-        sorted_games = sorted(game_lb.items(), key=lambda i: i[1], reverse=True)
+        guild_data = await load_guild_data(guild_id_str)
+        zone = guild_data.zone()
+        next_at = min(next_at or float("inf"), week_start(now, zone, weeks=1))
+        if guild_data.started < week_start(now, zone):
+            print(f"Rolling over leaderboards for guild: {guild.name} ({guild.id})")
+            record_event("reset", guild=guild_id_str, generation=guild_data.generation + 1)
+        if guild_data.announced < guild_data.generation - 1:
+            to_announce.append((guild, announcement_channel, guild_data.generation - 1))
 
-        embed = discord.Embed(
-            title="🏆 The Weekly Grind is Over! 🏆",
-            description="The dust has settled on another epic week of gaming! A huge congratulations to this week's champions. **The leaderboards have now been wiped clean for a fresh start!**",
-            color=discord.Color.gold(),
-            timestamp=datetime.datetime.now(datetime.UTC)
-        )
-        # NEW: Fixed thumbnail with a direct image link
-        embed.set_thumbnail(url="https://i.imgur.com/rXf2z2i.png")
-
-        if sorted_users:
-            top_user_id_str, top_user_seconds = sorted_users[0]
-            top_user = guild.get_member(int(top_user_id_str))
-            top_user_mention = top_user.mention if top_user else f"User ({top_user_id_str})"
-            embed.add_field(
-                name="👑 Weekly Gaming Champion",
-                value=f"{top_user_mention}\n**Time Played:** `{format_duration(top_user_seconds)}`",
-                inline=True
-            )
-        else:
-            embed.add_field(name="👑 Weekly Gaming Champion", value="*No one played this week!*", inline=True)
-
-        if sorted_games:
-            top_game_name, top_game_seconds = sorted_games[0]
-            embed.add_field(
-                name="🎮 Most Dominant Game",
-                value=f"**{top_game_name}**\n**Total Playtime:** `{format_duration(top_game_seconds)}`",
-                inline=True
-            )
-        else:
-            embed.add_field(name="🎮 Most Dominant Game", value="*No games were tracked!*", inline=True)
+    if not to_announce:
+        return next_at
 
-        if len(sorted_users) > 1:
-            embed.add_field(name='\u200b', value='\u200b', inline=False)
-            honorable_mentions = []
-            for i, (user_id_str, total_seconds) in enumerate(sorted_users[1:3], start=2):
-                member = guild.get_member(int(user_id_str))
-                name = member.display_name if member else f"User ({user_id_str})"
-                emoji = "🥈" if i == 2 else "🥉"
-                honorable_mentions.append(f"{emoji} **{name}**: `{format_duration(total_seconds)}`")
-            embed.add_field(name="🏅 Hall of Fame", value="\n".join(honorable_mentions), inline=False)
+    print("--- RUNNING WEEKLY LEADERBOARD ANNOUNCEMENTS ---")
+    # The writer runs jobs in order, so the archive reads below see what this queues.
+    compact_data()
 
-        embed.set_footer(text="A new week begins now. Good luck, everyone!")
+    for guild, announcement_channel, generation in to_announce:
+        guild_id_str = str(guild.id)
+        record = await writer.call(week_archive.read, guild_id_str, generation)
+        if record is None:
+            print(f"  -> Week {generation} of {guild.name} is not archived yet; will retry.")
+            next_at = None  # Retry after the job's interval
+            continue
 
         try:
-            await announcement_channel.send(embed=embed)
+            await announcement_channel.send(embed=weekly_embed(guild, record))
             print(f"  -> Announcement sent for {guild.name}.")
         except discord.Forbidden:
             print(f"  -> FAILED to send announcement for {guild.name} (Missing Permissions).")
         except discord.HTTPException as e:
             print(f"  -> FAILED to send announcement for {guild.name}: {e}")
+            next_at = None
+            continue
+        # Missing permissions won't fix themselves, so only transient failures are retried.
+        record_event("announced", guild=guild_id_str, generation=generation)
+
+    flush_data()
+    print("--- WEEKLY ANNOUNCEMENTS COMPLETE. ---")
+    return next_at
+
+
+async def flush_data_periodically():
+    """Fsyncs buffered events every SAVE_INTERVAL_SECONDS and compacts the log when it grows too large."""
+    flush_data()
 
-        if guild_id_str in leaderboard_data:
-            leaderboard_data[guild_id_str] = {}
-            print(f"  -> User leaderboard reset for {guild.name}.")
-        if guild_id_str in game_leaderboard_data:
-            game_leaderboard_data[guild_id_str] = {}
-            print(f"  -> Game leaderboard reset for {guild.name}.")
 
-    save_data(LEADERBOARD_FILE, leaderboard_data)
-    save_data(GAME_LEADERBOARD_FILE, game_leaderboard_data)
-    print("--- WEEKLY RESET COMPLETE. DATA SAVED. ---")
+async def evict_idle_guilds_periodically():
+    """Keeps resident memory proportional to the guilds that are actually active."""
+    evicted = evict_idle_guilds()
+    if evicted:
+        print(f"LOG: Evicted {evicted} idle guilds from memory ({len(guild_cache)} still resident).")
 
 
-@check_milestones.before_loop
-@update_leaderboards_periodically.before_loop
-@weekly_reset_and_announce.before_loop
-async def before_tasks():
-    """Ensures the bot is ready before starting any background tasks."""
-    await bot.wait_until_ready()
+job_scheduler.add("heartbeat", update_leaderboards_periodically, 5 * 60)
+# Sleeps until the next local Monday 00:00; the hourly interval only applies while an
+# announcement is waiting to be retried or this process isn't the leader.
+job_scheduler.add("weekly", weekly_reset_and_announce, 60 * 60)
+job_scheduler.add("flush", flush_data_periodically, SAVE_INTERVAL_SECONDS)
+job_scheduler.add("evict", evict_idle_guilds_periodically, 60)
 
 
 # --- COMMANDS ---
 @bot.command(name="leaderboard", aliases=["lb"], help="Shows the server's gaming leaderboard for users.")
 async def leaderboard(ctx):
-    guild_id_str = str(ctx.guild.id)
-    if guild_id_str not in leaderboard_data or not leaderboard_data[guild_id_str]:
+    guild_data = await load_guild_data(ctx.guild.id)
+    if not guild_data.users:
         await ctx.send("No user leaderboard data has been recorded for this server yet!")
         return
 
-    sorted_users = sorted(leaderboard_data[guild_id_str].items(), key=lambda item: item[1], reverse=True)
     embed = discord.Embed(title=f"🏆 Top Gamers in {ctx.guild.name}", color=discord.Color.gold())
     description = ""
-    for i, (user_id_str, total_seconds) in enumerate(sorted_users[:10], 1):
+    for i, (user_id_str, total_seconds) in enumerate(guild_data.users.top(10), 1):
         member = ctx.guild.get_member(int(user_id_str))
         name = member.display_name if member else f"User ({user_id_str})"
         emoji = ["🥇", "🥈", "🥉"][i - 1] if i <= 3 else "🔹"
@@ -436,21 +2795,34 @@ async def leaderboard(ctx):
 
 @bot.command(name="topgames", aliases=["tg"], help="Shows the most played games on the server.")
 async def topgames(ctx):
-    guild_id_str = str(ctx.guild.id)
-    if guild_id_str not in game_leaderboard_data or not game_leaderboard_data[guild_id_str]:
+    guild_data = await load_guild_data(ctx.guild.id)
+    if not guild_data.games:
         await ctx.send("No game leaderboard data has been recorded for this server yet!")
         return
 
-    sorted_games = sorted(game_leaderboard_data[guild_id_str].items(), key=lambda item: item[1], reverse=True)
     embed = discord.Embed(title=f"🎮 Most Played Games in {ctx.guild.name}", color=discord.Color.orange())
     description = ""
-    for i, (game_name, total_seconds) in enumerate(sorted_games[:10], 1):
+    for i, (game_id, total_seconds) in enumerate(guild_data.games.top(10), 1):
+        game_name = game_catalog.name(game_id)
         emoji = ["🥇", "🥈", "🥉"][i - 1] if i <= 3 else "🔹"
         description += f"{emoji} **{game_name}**: {format_duration(total_seconds)}\n"
     embed.description = description
     await ctx.send(embed=embed)
 
 
+@bot.command(name="rank", help="Shows where you (or another member) stand on this week's leaderboard.")
+async def rank(ctx, member: discord.Member = None):
+    member = member or ctx.author
+    guild_data = await load_guild_data(ctx.guild.id)
+    position = guild_data.users.rank(str(member.id))
+    if position is None:
+        await ctx.send(f"**{member.display_name}** hasn't played anything this week yet!")
+        return
+    total_seconds = guild_data.users.get(str(member.id))
+    await ctx.send(f"🏅 **{member.display_name}** is ranked **#{position}** of {len(guild_data.users)} "
+                   f"with {format_duration(total_seconds)} played this week.")
+
+
 # NEW: Overhauled command to check both required channels.
 @bot.command(name="checkchannels", help="Checks if the bot can find and use the required channels.")
 async def check_channels(ctx):
@@ -487,14 +2859,13 @@ async def check_channels(ctx):
 @bot.command(name="whoplays", help="Shows who is currently playing a specific game.")
 async def whoplays(ctx, *, game_name: str):
     playing_now = []
-    now = datetime.datetime.now(datetime.UTC)
-    guild_id = ctx.guild.id
-    for user_id, info in playing_start_times.items():
-        if info["game"].lower() == game_name.lower() and info["guild_id"] == guild_id:
-            member = ctx.guild.get_member(user_id)
-            if member:
-                duration = format_duration((now - info["start_time"]).total_seconds())
-                playing_now.append(f"• **{member.display_name}** (for {duration})")
+    now = time.time()
+    game_id = game_catalog.lookup(game_name)
+    for user_id in playing_start_times.players(ctx.guild.id, game_id):
+        member = ctx.guild.get_member(user_id)
+        if member:
+            duration = format_duration(now - playing_start_times[user_id].start_time)
+            playing_now.append(f"• **{member.display_name}** (for {duration})")
 
     if not playing_now:
         await ctx.send(f"No one is currently playing **{game_name}** in this server.")
@@ -504,15 +2875,140 @@ async def whoplays(ctx, *, game_name: str):
     await ctx.send(embed=embed)
 
 
+@bot.command(name="nowplaying", aliases=["np"], help="Shows what everyone on the server is playing right now.")
+async def now_playing(ctx):
+    games = playing_start_times.games_in(ctx.guild.id)
+    if not games:
+        await ctx.send("No one is playing anything in this server right now.")
+        return
+    ranked = sorted(games.items(), key=lambda item: len(item[1]), reverse=True)
+    description = ""
+    for game_id, players in ranked[:15]:
+        count = len(players)
+        description += f"🎮 **{game_catalog.name(game_id)}**: {count} {'player' if count == 1 else 'players'}\n"
+    if len(ranked) > 15:
+        description += f"…and {len(ranked) - 15} more games."
+    total = sum(len(players) for players in games.values())
+    embed = discord.Embed(title=f"🕹️ Now Playing in {ctx.guild.name}", description=description,
+                          color=discord.Color.green())
+    embed.set_footer(text=f"{total} members in {len(games)} games")
+    await ctx.send(embed=embed)
+
+
+@bot.command(name="history", help="Shows playtime over the last N days (default 30). Usage: !history [days] [@member]")
+async def playtime_history(ctx, days: int = 30, member: discord.Member = None):
+    member = member or ctx.author
+    since, days = history_since(days)
+    games = await writer.call(session_history.user_games, ctx.guild.id, member.id, since)
+    if not games:
+        await ctx.send(f"**{member.display_name}** has no finished sessions in the last {days} days.")
+        return
+    total = sum(seconds for _, seconds in games)
+    description = "\n".join(f"🎮 **{archived_game_name(game)}**: {format_duration(seconds)}"
+                            for game, seconds in games[:10])
+    embed = discord.Embed(title=f"📅 {member.display_name}: last {days} days", description=description,
+                          color=discord.Color.blue())
+    embed.set_footer(text=f"Total: {format_duration(total)} across {len(games)} games")
+    await ctx.send(embed=embed)
+
+
+@bot.command(name="populargames", aliases=["pg"], help="Shows the most played games over the last N days (default 30).")
+async def popular_games(ctx, days: int = 30):
+    since, days = history_since(days)
+    games = await writer.call(session_history.top_games, ctx.guild.id, since)
+    if not games:
+        await ctx.send(f"No finished sessions have been recorded in the last {days} days.")
+        return
+    description = ""
+    for i, (game, seconds, players) in enumerate(games, 1):
+        emoji = ["🥇", "🥈", "🥉"][i - 1] if i <= 3 else "🔹"
+        description += (f"{emoji} **{archived_game_name(game)}**: {format_duration(seconds)} "
+                        f"({players} {'player' if players == 1 else 'players'})\n")
+    embed = discord.Embed(title=f"📈 Top Games in {ctx.guild.name}: last {days} days", description=description,
+                          color=discord.Color.purple())
+    await ctx.send(embed=embed)
+
+
+@bot.command(name="lastweek", aliases=["lw"], help="Shows an archived weekly leaderboard. Usage: !lastweek [weeks ago, default 1]")
+async def last_week(ctx, weeks_ago: int = 1):
+    guild_id_str = str(ctx.guild.id)
+    flush_data()  # Include a rollover that hasn't been handed to the writer yet
+    archived = await writer.call(week_archive.index, guild_id_str)
+    if not 1 <= weeks_ago <= len(archived):
+        await ctx.send(f"Only {len(archived)} past weeks are archived for this server.")
+        return
+    record = await writer.call(week_archive.read, guild_id_str, archived[-weeks_ago]["generation"])
+    started = datetime.datetime.fromtimestamp(record["started"], datetime.UTC)
+    ended = datetime.datetime.fromtimestamp(record["ended"], datetime.UTC)
+
+    embed = discord.Embed(title=f"📜 Leaderboard for {started:%b %d} – {ended:%b %d, %Y}", color=discord.Color.dark_gold())
+    description = ""
+    for i, (user_id_str, total_seconds) in enumerate(
+            heapq.nlargest(10, record["users"].items(), key=lambda item: item[1]), 1):
+        member = ctx.guild.get_member(int(user_id_str))
+        name = member.display_name if member else f"User ({user_id_str})"
+        emoji = ["🥇", "🥈", "🥉"][i - 1] if i <= 3 else "🔹"
+        description += f"{emoji} **{name}**: {format_duration(total_seconds)}\n"
+    embed.add_field(name="Players", value=description or "*No one played that week.*", inline=False)
+    games = heapq.nlargest(5, record["games"].items(), key=lambda item: item[1])
+    embed.add_field(name="Games", value="\n".join(f"🎮 **{archived_game_name(key)}**: {format_duration(seconds)}"
+                                                 for key, seconds in games) or "*No games were tracked.*", inline=False)
+    await ctx.send(embed=embed)
+
+
+@bot.command(name="pastweeks", help="Lists the archived weekly leaderboards of this server.")
+async def past_weeks(ctx):
+    flush_data()
+    archived = await writer.call(week_archive.index, str(ctx.guild.id))
+    if not archived:
+        await ctx.send("No past weeks have been archived for this server yet.")
+        return
+    lines = []
+    for weeks_ago, entry in enumerate(reversed(archived[-20:]), 1):
+        started = datetime.datetime.fromtimestamp(entry["started"], datetime.UTC)
+        ended = datetime.datetime.fromtimestamp(entry["ended"], datetime.UTC)
+        lines.append(f"`{weeks_ago:>2}` {started:%b %d} – {ended:%b %d, %Y}")
+    embed = discord.Embed(title=f"🗄️ Archived Weeks in {ctx.guild.name}", description="\n".join(lines),
+                          color=discord.Color.dark_gold())
+    embed.set_footer(text="Use !lastweek <number> to view one.")
+    await ctx.send(embed=embed)
+
+
+@bot.command(name="timezone", help="Shows or sets the timezone weeks roll over in. Usage: !timezone [Europe/Berlin]")
+@commands.has_permissions(manage_guild=True)
+async def set_timezone(ctx, name: str = None):
+    guild_id_str = str(ctx.guild.id)
+    guild_data = await load_guild_data(guild_id_str)
+    if name is None:
+        next_rollover = int(week_start(time.time(), guild_data.zone(), weeks=1))
+        await ctx.send(f"🕛 Weeks roll over at Monday 00:00 **{guild_data.timezone or ROLLOVER_TIMEZONE}**. "
+                       f"Next rollover: <t:{next_rollover}:F>")
+        return
+    try:
+        guild_zone(name)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        await ctx.send(f"❌ Unknown timezone `{name}`. Use a name like `Europe/Berlin` or `America/New_York`.")
+        return
+    record_event("timezone", guild=guild_id_str, timezone=name)
+    flush_data()
+    job_scheduler.run_soon("weekly")  # The next rollover may now be earlier
+    await ctx.send(f"✅ Weeks now roll over at Monday 00:00 **{name}**.")
+
+
+@set_timezone.error
+async def set_timezone_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send("❌ You need the 'Manage Server' permission to use this command.")
+
+
 @bot.command(name="addgamerole", help="Links a game to a role. Usage: !addgamerole \"Game Name\" @Role")
 @commands.has_permissions(manage_roles=True)
 async def add_game_role(ctx, game_name: str, role: discord.Role):
     guild_id_str = str(ctx.guild.id)
-    game_name_lower = game_name.lower()
-    if guild_id_str not in game_roles:
-        game_roles[guild_id_str] = {}
-    game_roles[guild_id_str][game_name_lower] = role.id
-    save_data(GAME_ROLES_FILE, game_roles)
+    await load_guild_data(guild_id_str)
+    record_event("role", guild=guild_id_str, game=game_name, role=role.id)
+    flush_data()
+    await role_reconciler.request_guild(ctx.guild)  # Give the role to anyone already playing
     await ctx.send(f"✅ Successfully linked the game **{game_name}** to the `{role.name}` role.")
 
 
@@ -533,16 +3029,11 @@ async def reset_stats(ctx):
         return
 
     guild_id_str = str(ctx.guild.id)
-    
-    # Reset User Leaderboard
-    if guild_id_str in leaderboard_data:
-        leaderboard_data[guild_id_str] = {}
-        save_data(LEADERBOARD_FILE, leaderboard_data)
 
-    # Reset Game Leaderboard
-    if guild_id_str in game_leaderboard_data:
-        game_leaderboard_data[guild_id_str] = {}
-        save_data(GAME_LEADERBOARD_FILE, game_leaderboard_data)
+    # Start a new generation for both leaderboards; the old one goes to the archive unannounced
+    guild_data = await load_guild_data(guild_id_str)
+    record_event("reset", guild=guild_id_str, generation=guild_data.generation + 1, silent=True)
+    flush_data()
 
     await ctx.send("⚠️ **SERVER WIPE** ⚠️\nAll leaderboard statistics for this server have been reset by the boss.")
 
@@ -551,9 +3042,28 @@ async def reset_stats(ctx):
 async def handle(request):
     return web.Response(text="Bot is running!")
 
+
+async def handle_metrics(request):
+    """Exposes persistence health, including the writer queue depth, as JSON."""
+    return web.json_response({
+        "writer": writer.stats(),
+        "buffered_events": len(event_log.buffer),
+        "event_log_bytes": event_log.size,
+        "active_sessions": len(playing_start_times),
+        "scheduled_milestones": len(milestone_scheduler.heap),
+        "resident_guilds": len(guild_cache),
+        "role_sync": dict(role_reconciler.stats, queued=sum(map(len, role_reconciler.dirty.values()))),
+        "shards": shard_stats(),
+        "presence_pipeline": presence_pipeline.stats(),
+        "leader": {"instance": INSTANCE_ID or None, "lease": LEASE_NAME, "is_leader": leader.is_leader},
+        "scheduler": job_scheduler.status(),
+        "outbox": dict(outbox_stats, pending_lines=sum(len(o.urgent) + len(o.lines) for o in outboxes.values())),
+    })
+
 async def keep_alive():
     app = web.Application()
     app.router.add_get('/', handle)
+    app.router.add_get('/metrics', handle_metrics)
     runner = web.AppRunner(app)
     await runner.setup()
     port = int(os.environ.get("PORT", 8080))
@@ -574,8 +3084,26 @@ async def main():
         print("2. Add this line to the .env file: DISCORD_TOKEN='your_bot_token_here'")
         return
 
-    async with bot:
-        await bot.start(TOKEN)
+    writer.start()
+    leader.start()
+    presence_pipeline.start()
+    # The dyno stops the process with SIGTERM; closing the bot lets the cleanup below run.
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, lambda: asyncio.create_task(bot.close()))
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows has no loop signal handlers; Ctrl+C still raises KeyboardInterrupt
+    try:
+        async with bot:
+            await bot.start(TOKEN)
+    finally:
+        # Fold the log into a fresh snapshot so the next start has nothing to replay.
+        compact_data(block=True)
+        if INSTANCE_ID and leader.is_leader:
+            # Let a standby take over right away instead of waiting for the lease to expire.
+            writer.submit(functools.partial(storage.release_lease, LEASE_NAME, INSTANCE_ID), block=True)
+        writer.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,66 @@
+"""
+Everything logged and flushed before a crash must be back after a restart, even though no
+snapshot was written: the restart replays the event log on top of the last snapshot.
+"""
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PHASE = textwrap.dedent("""
+    import asyncio, json, os, sys
+    sys.path.insert(0, sys.argv[2])
+    import presence_bot as pb
+
+    def state():
+        guild_data = pb.get_guild_data("42")
+        return {"users": guild_data.users.scores,
+                "games": {pb.game_catalog.name(game_id): s for game_id, s in guild_data.games.scores.items()},
+                "sessions": {str(user_id): [info.game, info.last_updated]
+                             for user_id, info in pb.playing_start_times.items()}}
+
+    async def main():
+        pb.writer.start()
+        if sys.argv[1] == "crash":
+            await pb.load_guild_data(42)
+            pb.record_event("start", user=1, guild=42, game="Dota 2", channel=None)
+            pb.playing_start_times[1].last_updated -= 100
+            pb.record_event("stop", user=1)
+            pb.record_event("start", user=2, guild=42, game="Celeste", channel=None)
+            pb.playing_start_times[2].last_updated -= 50
+            pb.record_event("accrue", skip_users=[], skip_shards=[])
+            pb.flush_data(block=True)
+            await pb.writer.call(lambda: None)
+            print(json.dumps(state()))
+            sys.stdout.flush()
+            os._exit(0)  # Crash: no compaction, no snapshot
+        print(json.dumps(state()))
+
+    asyncio.run(main())
+    pb.writer.stop()
+""")
+
+
+def run_phase(phase, data_dir, backend):
+    env = dict(os.environ, STORAGE_BACKEND=backend)
+    env.pop("INSTANCE_ID", None)
+    result = subprocess.run([sys.executable, "-c", PHASE, phase, BOT_DIR], cwd=data_dir, env=env,
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_flushed_events_survive_a_crash(tmp_path, backend):
+    before = run_phase("crash", tmp_path, backend)
+    after = run_phase("restart", tmp_path, backend)
+
+    assert before["users"]["1"] == pytest.approx(100, abs=1)
+    assert before["users"]["2"] == pytest.approx(50, abs=1)
+    assert list(before["sessions"]) == ["2"]
+    assert after == before
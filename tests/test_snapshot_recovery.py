@@ -0,0 +1,62 @@
+"""
+A guild file that fails its checksum must be recovered from the previous generation plus
+the retained log segments, without losing anything that was logged.
+"""
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PHASE = textwrap.dedent("""
+    import asyncio, json, sys
+    sys.path.insert(0, sys.argv[2])
+    import presence_bot as pb
+
+    async def main():
+        pb.writer.start()
+        if sys.argv[1] == "seed":
+            await pb.load_guild_data(111)
+            for i in range(3):
+                pb.record_event("start", user=5, guild=111, game="Dota 2", channel=None)
+                pb.playing_start_times[5].last_updated -= 100
+                pb.record_event("stop", user=5)
+                if i < 2:
+                    pb.compact_data(block=True)  # Two generations of the guild file
+            pb.flush_data(block=True)
+        else:
+            guild_data = await pb.load_guild_data(111)
+            print(json.dumps({"users": guild_data.users.scores,
+                              "games": {pb.game_catalog.name(g): s for g, s in guild_data.games.scores.items()}}))
+
+    asyncio.run(main())
+    pb.writer.stop()
+""")
+
+
+def run_phase(phase, data_dir):
+    env = dict(os.environ, STORAGE_BACKEND="json")
+    env.pop("INSTANCE_ID", None)
+    result = subprocess.run([sys.executable, "-c", PHASE, phase, BOT_DIR], cwd=data_dir, env=env,
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    return result.stdout
+
+
+def test_corrupt_guild_file_is_recovered_from_generation_1_and_the_log(tmp_path):
+    run_phase("seed", tmp_path)
+    guild_file = tmp_path / "data" / "guilds" / "111.json"
+    raw = bytearray(guild_file.read_bytes())
+    raw[-3] ^= 1  # Flip a bit in the payload so the checksum no longer matches
+    guild_file.write_bytes(bytes(raw))
+
+    output = run_phase("restart", tmp_path)
+    result = json.loads(output.strip().splitlines()[-1])
+
+    assert "from generation 1" in output
+    assert result["users"]["5"] == pytest.approx(300, abs=1)
+    assert result["games"]["Dota 2"] == pytest.approx(300, abs=1)
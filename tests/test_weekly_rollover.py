@@ -0,0 +1,78 @@
+"""
+The weekly rollover must catch up after downtime: playtime recorded in one week is rolled
+over and announced by the first weekly run after a restart in a later week. Each phase runs
+in its own process, since the bot picks its storage backend and data folder at import.
+"""
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PHASE = textwrap.dedent("""
+    import asyncio, json, sys, time
+    if sys.argv[1] == "restart":
+        real_time = time.time
+        time.time = lambda: real_time() + 8 * 86400  # Restart eight days later
+    sys.path.insert(0, sys.argv[2])
+    import presence_bot as pb
+
+    sent = []
+
+    class Channel:
+        async def send(self, embed=None, **kwargs):
+            sent.append(embed.fields[0].value)
+
+    class Guild:
+        id = 42
+        name = "test"
+
+        def get_member(self, user_id):
+            return None
+
+    pb.get_text_channel_by_name = lambda guild, name: Channel()
+    type(pb.bot).guilds = property(lambda self: [Guild()])
+
+    async def main():
+        pb.writer.start()
+        guild_data = await pb.load_guild_data(42)
+        if sys.argv[1] == "seed":
+            pb.record_event("start", user=1, guild=42, game="Dota 2", channel=None)
+            pb.playing_start_times[1].last_updated -= 500
+            pb.record_event("stop", user=1)
+            pb.compact_data(block=True)
+            return
+        before = dict(guild_data.users.scores)
+        await pb.weekly_reset_and_announce()
+        guild_data = pb.guild_cache["42"]
+        print(json.dumps({"before": before, "after": guild_data.users.scores, "generation": guild_data.generation,
+                          "announced": guild_data.announced, "sent": sent}))
+
+    asyncio.run(main())
+    pb.writer.stop()
+""")
+
+
+def run_phase(phase, data_dir, backend):
+    env = dict(os.environ, STORAGE_BACKEND=backend)
+    env.pop("INSTANCE_ID", None)
+    result = subprocess.run([sys.executable, "-c", PHASE, phase, BOT_DIR], cwd=data_dir, env=env,
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    return result.stdout
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_missed_rollover_is_caught_up_after_restart(tmp_path, backend):
+    run_phase("seed", tmp_path, backend)
+    result = json.loads(run_phase("restart", tmp_path, backend).strip().splitlines()[-1])
+
+    assert result["before"]["1"] == pytest.approx(500, abs=1)
+    assert result["after"] == {}
+    assert result["generation"] == 1
+    assert result["announced"] == 0
+    assert len(result["sent"]) == 1 and "User (1)" in result["sent"][0]